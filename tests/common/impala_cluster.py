@@ -17,17 +17,23 @@
 #
 # Basic object model of an Impala cluster (set of Impala processes).
 
+import ctypes
 import json
 import logging
+import multiprocessing
+import operator
 import os
 import psutil
+import re
+import select
 import socket
 import sys
 import time
-from getpass import getuser
-from random import choice
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from random import choice, randrange
 from signal import SIGKILL
-from subprocess import check_call
+from subprocess import check_call, Popen
 from time import sleep
 
 if sys.version_info >= (2, 7):
@@ -44,8 +50,16 @@ LOG = logging.getLogger('impala_cluster')
 LOG.setLevel(level=logging.DEBUG)
 
 IMPALA_HOME = os.environ['IMPALA_HOME']
-CATALOGD_PATH = os.path.join(IMPALA_HOME, 'bin/start-catalogd.sh')
-IMPALAD_PATH = os.path.join(IMPALA_HOME, 'bin/start-impalad.sh -build_type=latest')
+# Commands used to restart daemons. The daemon's own arguments are appended to these.
+CATALOGD_ARGV = [os.path.join(IMPALA_HOME, 'bin/start-catalogd.sh')]
+IMPALAD_ARGV = [os.path.join(IMPALA_HOME, 'bin/start-impalad.sh'), '-build_type=latest']
+
+# Matches a command line argument of the form '-name=value' or '--name=value'.
+ARG_PATTERN = re.compile(r'^-{1,2}([^=]+)=(.*)$')
+
+# Default for the 'hostname' argument of Impala processes. Looked up once since it is
+# needed for every process object.
+DEFAULT_HOSTNAME = socket.gethostname()
 
 DEFAULT_BEESWAX_PORT = 21000
 DEFAULT_HS2_PORT = 21050
@@ -61,6 +75,42 @@ DEFAULT_CATALOGD_WEBSERVER_PORT = 25020
 # flakiness.
 CLUSTER_WAIT_TIMEOUT_IN_SECONDS = 240
 
+# Bounds of the adaptive interval used when polling for the cluster to become ready.
+# Polling starts at the minimum interval and backs off towards the maximum, so that
+# services which come up quickly are detected quickly without hammering slow ones.
+MIN_POLL_INTERVAL_IN_SECONDS = 0.05
+MAX_POLL_INTERVAL_IN_SECONDS = 1.0
+
+# Minimum time between two progress messages logged while waiting for the cluster.
+PROGRESS_LOG_INTERVAL_IN_SECONDS = 5
+
+# Time for which the processes found by find_user_process_cmdlines() are reused. This
+# makes back-to-back refresh() calls cheap. The cache is invalidated whenever a process
+# is started or killed through this module, and bypassed when polling for processes
+# to come up.
+USER_PROCESS_CACHE_TTL_IN_SECONDS = 0.25
+
+# Number of the pidfd_open() system call (Linux >= 5.3). It is the same on all the
+# architectures we run on. Python 2 has no os.pidfd_open() so we call it through libc.
+SYS_PIDFD_OPEN = 434
+
+# Upper bound on the total time spent probing coordinators in
+# num_responsive_coordinators(). A healthy coordinator answers 'select 1' well within
+# this, so coordinators that have not answered by then are counted as unresponsive.
+COORDINATOR_PROBE_TIMEOUT_IN_SECONDS = 2
+
+
+def _get_num_usable_cpus():
+  """Returns the number of CPUs this process may run on."""
+  if hasattr(os, 'sched_getaffinity'):
+    return len(os.sched_getaffinity(0))
+  return multiprocessing.cpu_count()
+
+
+# Maximum number of threads used by ImpalaCluster to talk to its processes concurrently.
+# The work is I/O bound, so this is a multiple of the number of CPUs.
+IO_POOL_SIZE = min(32, _get_num_usable_cpus() * 4)
+
 
 # Represents a set of Impala processes.
 # Handles two cases:
@@ -85,8 +135,8 @@ class ImpalaCluster(object):
     else:
       self.__impalads, self.__statestoreds, self.__catalogd =\
           self.__find_docker_containers()
-    LOG.info("Found %d impalad/%d statestored/%d catalogd process(es)" %
-        (len(self.__impalads), len(self.__statestoreds), 1 if self.__catalogd else 0))
+    LOG.info("Found %d impalad/%d statestored/%d catalogd process(es)",
+        len(self.__impalads), len(self.__statestoreds), 1 if self.__catalogd else 0)
 
   @property
   def statestored(self):
@@ -120,24 +170,43 @@ class ImpalaCluster(object):
     """Selects an impalad that is different from the given impalad"""
     if len(self.impalads) <= 1:
       assert 0, "Only %d impalads available to choose from" % len(self.impalads)
-    LOG.info("other_impalad: " + str(other_impalad))
-    LOG.info("Cluster: " + str(len(self.impalads)))
-    LOG.info("Cluster: " + str(self.impalads))
-    return choice([impalad for impalad in self.impalads if impalad != other_impalad])
+    LOG.info("other_impalad: %s", other_impalad)
+    LOG.info("Cluster: %d", len(self.impalads))
+    LOG.info("Cluster: %s", self.impalads)
+    if other_impalad not in self.impalads:
+      return choice(self.impalads)
+    # Pick uniformly among the other impalads by skipping over 'other_impalad's index.
+    index = randrange(len(self.impalads) - 1)
+    if index >= self.impalads.index(other_impalad):
+      index += 1
+    return self.impalads[index]
 
   def num_responsive_coordinators(self):
-    """Find the number of impalad coordinators that can evaluate a test query."""
-    n = 0
-    for impalad in self.impalads:
-      try:
-        client = impalad.service.create_beeswax_client()
-        result = client.execute("select 1")
-        assert result.success
-        ++n
-      except Exception as e: print e
-      finally:
-        client.close()
-    return n
+    """Find the number of impalad coordinators that can evaluate a test query. The
+    impalads are probed concurrently, so a slow or hung impalad does not delay the
+    others. An impalad that does not answer within COORDINATOR_PROBE_TIMEOUT_IN_SECONDS
+    is counted as unresponsive."""
+    if len(self.impalads) == 0:
+      return 0
+    # One thread per impalad, so that every probe starts right away instead of queueing
+    # behind a hung one, and each probe gets the whole timeout to itself.
+    pool = ThreadPool(processes=len(self.impalads))
+    try:
+      results = [(impalad, time.time(), pool.apply_async(_probe_coordinator, (impalad,)))
+                 for impalad in self.impalads]
+      n = 0
+      for impalad, start_time, result in results:
+        try:
+          n += result.get(
+              max(0, start_time + COORDINATOR_PROBE_TIMEOUT_IN_SECONDS - time.time()))
+        except TimeoutError:
+          LOG.info("Timed out probing coordinator %s", impalad.service.hostname)
+      return n
+    finally:
+      # Unlike terminate(), close() lets each worker thread exit as soon as its probe
+      # returns. A probe blocked in an RPC cannot be interrupted, but it holds no
+      # reference to the cluster and runs in a daemon thread.
+      pool.close()
 
   def wait_until_ready(self, expected_num_impalads=1, expected_num_ready_impalads=None):
     """Waits for this 'cluster' to be ready to submit queries.
@@ -158,25 +227,52 @@ class ImpalaCluster(object):
     if expected_num_ready_impalads is None:
       expected_num_ready_impalads = len(self.impalads)
 
-    for impalad in self.impalads:
+    def wait_until_impalad_ready(impalad):
       impalad.service.wait_for_num_known_live_backends(expected_num_ready_impalads,
           timeout=CLUSTER_WAIT_TIMEOUT_IN_SECONDS, interval=2)
       if (impalad._get_arg_value("is_coordinator", default="true") == "true" and
          impalad._get_arg_value("stress_catalog_init_delay_ms", default=0) == 0):
         impalad.wait_for_catalog()
 
+    # The impalads are independent, so wait for all of them at the same time. map()
+    # re-raises the first exception hit by any of the waits.
+    pool = self.__create_io_pool()
+    try:
+      pool.map(wait_until_impalad_ready, self.impalads)
+    finally:
+      pool.terminate()
+
+  def __create_io_pool(self):
+    """Returns a new thread pool to talk to the impalads concurrently. The caller must
+    terminate() it, since its threads are not released otherwise."""
+    return ThreadPool(processes=max(1, min(len(self.impalads), IO_POOL_SIZE)))
+
   def wait_for_num_impalads(self, num_impalads, retries=10):
     """Checks that at least 'num_impalads' impalad processes are running, along with
     the statestored and catalogd.
 
     Refresh until the number running impalad processes reaches the expected
     number based on num_impalads, or the retry limit is hit. Failing this, raise a
-    RuntimeError.
+    RuntimeError. Each retry corresponds to up to MAX_POLL_INTERVAL_IN_SECONDS of
+    waiting; the refresh interval backs off from MIN_POLL_INTERVAL_IN_SECONDS.
     """
-    for i in range(retries):
-      if len(self.impalads) < num_impalads or not self.statestored or not self.catalogd:
-        sleep(1)
-        self.refresh()
+    deadline = time.time() + retries * MAX_POLL_INTERVAL_IN_SECONDS
+    interval = MIN_POLL_INTERVAL_IN_SECONDS
+    num_polls = 0
+    while True:
+      if len(self.impalads) >= num_impalads and self.statestored and self.catalogd:
+        LOG.info("Found %d impalad(s) after refreshing the cluster %d time(s)",
+            len(self.impalads), num_polls)
+        return
+      if time.time() >= deadline:
+        break
+      sleep(interval)
+      # The poll interval can be shorter than the process cache TTL, so force a rescan.
+      _invalidate_user_process_cache()
+      self.refresh()
+      num_polls += 1
+      interval = _next_poll_interval(interval)
+
     msg = ""
     if len(self.impalads) < num_impalads:
       msg += "Expected {expected_num} impalad(s), only {actual_num} found\n".format(
@@ -185,8 +281,7 @@ class ImpalaCluster(object):
       msg += "statestored failed to start.\n"
     if not self.catalogd:
       msg += "catalogd failed to start.\n"
-    if msg:
-      raise RuntimeError(msg)
+    raise RuntimeError(msg)
 
   def __build_impala_process_lists(self):
     """
@@ -198,26 +293,26 @@ class ImpalaCluster(object):
     impalads = list()
     statestored = list()
     catalogd = None
-    for process in find_user_processes(['impalad', 'catalogd', 'statestored']):
+    for pid, name, cmdline in find_user_process_cmdlines(
+        ['impalad', 'catalogd', 'statestored']):
       # IMPALA-6889: When a process shuts down and becomes a zombie its cmdline becomes
-      # empty for a brief moment, before it gets reaped by its parent (see man proc). We
-      # copy the cmdline to prevent it from changing between the following checks and
-      # the construction of the *Process objects.
-      cmdline = process.cmdline
+      # empty for a brief moment, before it gets reaped by its parent (see man proc).
+      # find_user_process_cmdlines() returns a copy of the cmdline, so it cannot change
+      # between the following checks and the construction of the *Process objects.
       if len(cmdline) == 0:
         continue
-      if process.name == 'impalad':
+      if name == 'impalad':
         impalads.append(ImpaladProcess(cmdline))
-      elif process.name == 'statestored':
+      elif name == 'statestored':
         statestored.append(StateStoreProcess(cmdline))
-      elif process.name == 'catalogd':
+      elif name == 'catalogd':
         catalogd = CatalogdProcess(cmdline)
 
     # If the operating system PIDs wrap around during startup of the local minicluster,
     # the order of the impalads is incorrect. We order them by their HS2 port, so that
     # get_first_impalad() always returns the first one. We need to use a port that is
     # exposed and mapped to a host port for the containerised cluster.
-    impalads.sort(key=lambda i: i.service.hs2_port)
+    impalads.sort(key=operator.attrgetter('hs2_port'))
     return impalads, statestored, catalogd
 
   def __find_docker_containers(self):
@@ -229,8 +324,16 @@ class ImpalaCluster(object):
     catalogd = None
     output = check_output(["docker", "network", "inspect", self.docker_network])
     # Only one network should be present in the top level array.
-    for container_id in json.loads(output)[0]["Containers"]:
-      container_info = self._get_container_info(container_id)
+    container_ids = list(json.loads(output)[0]["Containers"])
+    if len(container_ids) == 0:
+      return impalads, statestoreds, catalogd
+    # Inspect all the containers with a single docker invocation.
+    container_infos = json.loads(
+        check_output(["docker", "container", "inspect"] + container_ids))
+    assert len(container_infos) == len(container_ids),\
+        json.dumps(container_infos, indent=4)
+    for container_info in container_infos:
+      container_id = container_info["Id"]
       if container_info["State"]["Status"] != "running":
         # Skip over stopped containers.
         continue
@@ -253,7 +356,7 @@ class ImpalaCluster(object):
         assert catalogd is None
         catalogd = CatalogdProcess(args, container_id=container_id,
                                    port_map=port_map)
-    impalads.sort(key=lambda i: i.service.be_port)
+    impalads.sort(key=operator.attrgetter('be_port'))
     return impalads, statestoreds, catalogd
 
   def _get_container_info(self, container_id):
@@ -283,10 +386,23 @@ class Process(object):
     self.cmd = cmd
     self.container_id = container_id
     self.port_map = port_map
+    # Command line arguments of the form '-name=value' or '--name=value', by name. If an
+    # argument is given more than once, the first value is used.
+    self._args = {}
+    for arg in cmd:
+      match = ARG_PATTERN.match(arg.strip())
+      if match is not None:
+        self._args.setdefault(match.group(1), match.group(2))
+    self._cmd_tuple = tuple(cmd)
+    # The kernel truncates the command name in /proc/<pid>/comm to 15 characters.
+    self._cmd_comm = os.path.basename(cmd[0])[:15]
+    # psutil handle of the process, captured in kill() while the process is still alive
+    # so that wait_for_exit() can wait on it.
+    self._killed_process = None
 
   def get_pid(self):
     """Gets the PID of the process. Returns None if the PID cannot be determined"""
-    LOG.info("Attempting to find PID for %s" % ' '.join(self.cmd))
+    LOG.info("Attempting to find PID for %s", ' '.join(self.cmd))
     return self.__get_pid()
 
   def __get_pid(self):
@@ -298,40 +414,46 @@ class Process(object):
 
     # In non-containerised case, search for process based on matching command lines.
     for pid in psutil.get_pid_list():
+      # Only look at the full command line of processes with a matching name.
+      comm = _read_proc_comm(pid)
+      if comm is not None and comm != self._cmd_comm:
+        continue
       try:
         process = psutil.Process(pid)
-        if set(self.cmd) == set(process.cmdline):
+        if tuple(process.cmdline) == self._cmd_tuple:
           return pid
       except psutil.NoSuchProcess, e:
         # A process from get_pid_list() no longer exists, continue.
         LOG.info(e)
-    LOG.info("No PID found for process cmdline: %s. Process is dead?" % self.cmd)
+    LOG.info("No PID found for process cmdline: %s. Process is dead?", self.cmd)
     return None
 
   def start(self):
+    _invalidate_user_process_cache()
     if self.container_id is None:
-      LOG.info("Starting process: {0}".format(' '.join(self.cmd)))
-      # Use os.system() to start 'cmd' in the background via a shell so its parent will be
-      # init after the shell exits. Otherwise, the parent of 'cmd' will be py.test and we
-      # cannot cleanly kill it until py.test exits. In theory, Popen(shell=True) should
-      # achieve the same thing but it doesn't work on some platforms for some reasons.
-      os.system(' '.join(self.cmd) + ' &')
+      LOG.info("Starting process: %s", ' '.join(self.cmd))
+      _start_detached(self.cmd)
     else:
-      LOG.info("Starting container: {0}".format(self.container_id))
+      LOG.info("Starting container: %s", self.container_id)
       check_call(["docker", "container", "start", self.container_id])
 
   def kill(self, signal=SIGKILL):
     """
     Kills the given processes.
     """
+    _invalidate_user_process_cache()
     if self.container_id is None:
       pid = self.get_pid()
       if pid is None:
         assert 0, "No processes %s found" % self.cmd
-      LOG.info('Killing: %s (PID: %d) with signal %s' % (' '.join(self.cmd), pid, signal))
+      try:
+        self._killed_process = psutil.Process(pid)
+      except psutil.NoSuchProcess:
+        self._killed_process = None
+      LOG.info('Killing: %s (PID: %d) with signal %s', ' '.join(self.cmd), pid, signal)
       exec_process("kill -%d %d" % (signal, pid))
     else:
-      LOG.info("Stopping container: {0}".format(self.container_id))
+      LOG.info("Stopping container: %s", self.container_id)
       check_call(["docker", "container", "stop", self.container_id])
 
 
@@ -343,19 +465,62 @@ class Process(object):
 
   def wait_for_exit(self):
     """Wait until the process exits (or return immediately if it already has exited."""
-    LOG.info('Waiting for exit: {0} (PID: {1})'.format(
-        ' '.join(self.cmd), self.get_pid()))
+    try:
+      self.__wait_for_exit()
+    finally:
+      # Processes found before the exit must not be returned from the cache.
+      _invalidate_user_process_cache()
+
+  def __wait_for_exit(self):
+    if self.container_id is not None:
+      LOG.info("Waiting for container to stop: %s", self.container_id)
+      # Blocks until the container stops and prints its exit code.
+      check_output(["docker", "container", "wait", self.container_id])
+      return
+    pid = self.get_pid()
+    LOG.info('Waiting for exit: %s (PID: %s)', ' '.join(self.cmd), pid)
+    if pid is None:
+      return
+    # Block until the kernel reports the process as exited instead of repeatedly
+    # scanning all processes. Fall back to polling if pidfds are not supported, or if
+    # the process did not exit in time. The latter also covers 'pid' having been reused
+    # by another process, which the polling below does not mistake for ours.
+    pidfd = _pidfd_open(pid)
+    if pidfd is not None:
+      try:
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if poller.poll(CLUSTER_WAIT_TIMEOUT_IN_SECONDS * 1000):
+          return
+        LOG.info("PID %d did not exit within %d seconds, polling for it", pid,
+            CLUSTER_WAIT_TIMEOUT_IN_SECONDS)
+      finally:
+        os.close(pidfd)
+    killed_process, self._killed_process = self._killed_process, None
+    if pidfd is None and killed_process is not None and killed_process.pid == pid:
+      # Let psutil wait for the process that was killed. This reaps it if it is our
+      # child. A zombie that is not our child is only gone once its parent reaps it, so
+      # fall through to the polling below if that does not happen in time.
+      try:
+        killed_process.wait(timeout=CLUSTER_WAIT_TIMEOUT_IN_SECONDS)
+        return
+      except psutil.TimeoutExpired:
+        LOG.info("PID %d did not go away, polling for it", pid)
     while self.__get_pid() is not None:
       sleep(0.01)
 
   def __str__(self):
-    return "Command: %s PID: %s" % (self.cmd, self.get_pid())
+    # Looking up the PID scans all processes, so it is left to kill() and wait_for_exit(),
+    # which log the PID they act on.
+    return "Command: %s" % (self.cmd,)
 
 
 # Base class for all Impala processes
 class BaseImpalaProcess(Process):
   def __init__(self, cmd, container_id=None, port_map=None):
     super(BaseImpalaProcess, self).__init__(cmd, container_id, port_map)
+    # Host ports by argument name, filled in by _get_port().
+    self._ports = {}
     self.hostname = self._get_hostname()
 
   def _get_webserver_port(self, default=None):
@@ -366,13 +531,13 @@ class BaseImpalaProcess(Process):
     return self._get_arg_value("webserver_certificate_file", "")
 
   def _get_hostname(self):
-    return self._get_arg_value("hostname", socket.gethostname())
+    return self._get_arg_value("hostname", DEFAULT_HOSTNAME)
 
   def _get_arg_value(self, arg_name, default=None):
     """Gets the argument value for given argument name"""
-    for arg in self.cmd:
-      if ('%s=' % arg_name) in arg.strip().lstrip('-'):
-        return arg.split('=')[1]
+    value = self._args.get(arg_name)
+    if value is not None:
+      return value
     if default is None:
       assert 0, "No command line argument '%s' found." % arg_name
     return default
@@ -380,9 +545,12 @@ class BaseImpalaProcess(Process):
   def _get_port(self, arg_name, default):
     """Return the host port for the specified by the command line argument 'arg_name'.
     If 'self.port_map' is set, maps from container ports to host ports."""
-    port = int(self._get_arg_value(arg_name, default))
-    if self.port_map is not None:
-      port = self.port_map.get(port, port)
+    port = self._ports.get(arg_name)
+    if port is None:
+      port = int(self._get_arg_value(arg_name, default))
+      if self.port_map is not None:
+        port = self.port_map.get(port, port)
+      self._ports[arg_name] = port
     return port
 
 
@@ -390,12 +558,15 @@ class BaseImpalaProcess(Process):
 class ImpaladProcess(BaseImpalaProcess):
   def __init__(self, cmd, container_id=None, port_map=None):
     super(ImpaladProcess, self).__init__(cmd, container_id, port_map)
+    self.beeswax_port = self.__get_beeswax_port()
+    self.be_port = self.__get_be_port()
+    self.hs2_port = self.__get_hs2_port()
     self.service = ImpaladService(self.hostname,
                                   self._get_webserver_port(
                                       default=DEFAULT_IMPALAD_WEBSERVER_PORT),
-                                  self.__get_beeswax_port(),
-                                  self.__get_be_port(),
-                                  self.__get_hs2_port(),
+                                  self.beeswax_port,
+                                  self.be_port,
+                                  self.hs2_port,
                                   self._get_webserver_certificate_file())
 
   def __get_beeswax_port(self):
@@ -409,9 +580,10 @@ class ImpaladProcess(BaseImpalaProcess):
 
   def start(self, wait_until_ready=True):
     """Starts the impalad and waits until the service is ready to accept connections."""
-    restart_cmd = [IMPALAD_PATH] + self.cmd[1:] + ['&']
-    LOG.info("Starting Impalad process: %s" % ' '.join(restart_cmd))
-    os.system(' '.join(restart_cmd))
+    _invalidate_user_process_cache()
+    restart_cmd = IMPALAD_ARGV + self.cmd[1:]
+    LOG.info("Starting Impalad process: %s", ' '.join(restart_cmd))
+    _start_detached(restart_cmd)
     if wait_until_ready:
       self.service.wait_for_metric_value('impala-server.ready',
                                          expected_value=1, timeout=30)
@@ -424,24 +596,42 @@ class ImpaladProcess(BaseImpalaProcess):
     hs2_port_is_open = False
     num_dbs = 0
     num_tbls = 0
+    interval = MIN_POLL_INTERVAL_IN_SECONDS
+    num_polls = 0
+    last_progress_log_time = None
     while ((time.time() - start_time < CLUSTER_WAIT_TIMEOUT_IN_SECONDS) and
         not (beeswax_port_is_open and hs2_port_is_open)):
-      try:
-        num_dbs, num_tbls = self.service.get_metric_values(
-            ["catalog.num-databases", "catalog.num-tables"])
-        beeswax_port_is_open = self.service.beeswax_port_is_open()
-        hs2_port_is_open = self.service.hs2_port_is_open()
-      except Exception:
-        LOG.exception(("Client services not ready. Waiting for catalog cache: "
-            "({num_dbs} DBs / {num_tbls} tables). Trying again ...").format(
-                num_dbs=num_dbs,
-                num_tbls=num_tbls))
-      sleep(0.5)
+      num_polls += 1
+      # Ports stay open once they have been opened, so only probe the ones that were
+      # closed at the last check. The HS2 port is not probed while the beeswax port is
+      # still closed.
+      beeswax_port_is_open = beeswax_port_is_open or self.service.beeswax_port_is_open()
+      hs2_port_is_open = beeswax_port_is_open and (
+          hs2_port_is_open or self.service.hs2_port_is_open())
+      if beeswax_port_is_open and hs2_port_is_open:
+        break
+      # The catalog metrics are only needed to report progress, which is logged at most
+      # every PROGRESS_LOG_INTERVAL_IN_SECONDS.
+      now = time.time()
+      if (last_progress_log_time is None or
+          now - last_progress_log_time >= PROGRESS_LOG_INTERVAL_IN_SECONDS):
+        last_progress_log_time = now
+        try:
+          num_dbs, num_tbls = self.service.get_metric_values(
+              ["catalog.num-databases", "catalog.num-tables"])
+        except Exception, e:
+          # Expected while the webserver is starting up.
+          LOG.info("Unable to read catalog metrics: %s", e)
+        LOG.info("Client services not ready. Waiting for catalog cache: "
+            "(%s DBs / %s tables). Trying again ...", num_dbs, num_tbls)
+      sleep(interval)
+      interval = _next_poll_interval(interval)
 
     if not hs2_port_is_open or not beeswax_port_is_open:
       raise RuntimeError(
           "Unable to open client ports within {num_seconds} seconds.".format(
               num_seconds=CLUSTER_WAIT_TIMEOUT_IN_SECONDS))
+    LOG.info("Client ports of %s open after %d poll(s)", self.hostname, num_polls)
 
 
 # Represents a statestored process
@@ -466,24 +656,160 @@ class CatalogdProcess(BaseImpalaProcess):
 
   def start(self, wait_until_ready=True):
     """Starts catalogd and waits until the service is ready to accept connections."""
-    restart_cmd = [CATALOGD_PATH] + self.cmd[1:] + ["&"]
-    LOG.info("Starting Catalogd process: %s" % ' '.join(restart_cmd))
-    os.system(' '.join(restart_cmd))
+    _invalidate_user_process_cache()
+    restart_cmd = CATALOGD_ARGV + self.cmd[1:]
+    LOG.info("Starting Catalogd process: %s", ' '.join(restart_cmd))
+    _start_detached(restart_cmd)
     if wait_until_ready:
       self.service.wait_for_metric_value('statestore-subscriber.connected',
                                          expected_value=1, timeout=30)
 
 
+def _detach():
+  """Runs in the child forked by Popen() in _start_detached(). Starts a new session and
+  forks again, letting the intermediate process exit so that init adopts the process
+  that goes on to exec the command."""
+  os.setsid()
+  if os.fork() != 0:
+    os._exit(0)
+
+
+def _start_detached(cmd):
+  """Starts 'cmd' in the background, without going through a shell.
+  This used to run 'cmd &' through os.system(), so that the shell exited and init became
+  the parent of 'cmd'. Otherwise the parent is py.test, and a process that exits or is
+  killed stays a zombie, which still shows up in process scans, until py.test reaps it.
+  To keep init as the parent, the process is started through an intermediate child
+  that exits right away (see _detach()). It runs in its own session, detached from
+  py.test's terminal and process group, so signals sent to py.test don't reach it.
+  Popen() still raises if 'cmd' cannot be executed, since the grandchild inherits the
+  pipe that reports exec() failures."""
+  intermediate = Popen(cmd, close_fds=True, preexec_fn=_detach)
+  # Reaps the intermediate process, which exits as soon as it has forked.
+  intermediate.wait()
+
+
 def find_user_processes(binaries):
   """Returns an iterator over all processes owned by the current user with a matching
   binary name from the provided list."""
-  for pid in psutil.get_pid_list():
+  uid = os.getuid()
+  # process_iter() reuses the psutil.Process objects of processes it has seen before and
+  # skips processes that have gone away.
+  for process in psutil.process_iter():
+    # Reading the short 'comm' file rules out nearly all processes before reading any
+    # attributes through psutil.
+    comm = _read_proc_comm(process.pid)
+    if comm is not None and comm not in binaries:
+      continue
     try:
-      process = psutil.Process(pid)
-      if process.username == getuser() and process.name in binaries: yield process
-    except KeyError, e:
-      if "uid not found" not in str(e):
-        raise
-    except psutil.NoSuchProcess, e:
+      # Compare uids rather than user names to avoid a passwd lookup per process.
+      if process.name in binaries and process.uids.real == uid: yield process
+    except psutil.NoSuchProcess:
       # Ignore the case when a process no longer exists.
       pass
+
+
+# Maps (uid, binaries) to a (timestamp, [(pid, name, cmdline)]) tuple.
+_user_process_cache = {}
+
+
+def find_user_process_cmdlines(binaries):
+  """Returns a list of (pid, name, cmdline) tuples for all processes owned by the
+  current user with a matching binary name from the provided list. The result of a
+  scan is reused for USER_PROCESS_CACHE_TTL_IN_SECONDS."""
+  key = (os.getuid(), tuple(binaries))
+  cached = _user_process_cache.get(key)
+  if cached is not None and time.time() - cached[0] < USER_PROCESS_CACHE_TTL_IN_SECONDS:
+    return cached[1]
+  scan_time = time.time()
+  if os.path.isdir("/proc"):
+    processes = _scan_proc(binaries)
+  else:
+    processes = []
+    for process in find_user_processes(binaries):
+      try:
+        processes.append((process.pid, process.name, list(process.cmdline)))
+      except psutil.NoSuchProcess:
+        pass
+  _user_process_cache[key] = (scan_time, processes)
+  return processes
+
+
+def _scan_proc(binaries):
+  """Implements find_user_process_cmdlines() by reading /proc directly, which is much
+  cheaper than going through psutil. Only /proc/<pid>/stat is read for processes that
+  don't match."""
+  uid = os.getuid()
+  processes = []
+  for entry in os.listdir("/proc"):
+    if not entry.isdigit():
+      continue
+    proc_dir = "/proc/" + entry
+    try:
+      with open(proc_dir + "/stat", "rb") as stat_file:
+        stat = stat_file.read()
+      # The command name is enclosed in parentheses and may itself contain them.
+      name = stat[stat.find("(") + 1:stat.rfind(")")]
+      if name not in binaries or os.stat(proc_dir).st_uid != uid:
+        continue
+      with open(proc_dir + "/cmdline", "rb") as cmdline_file:
+        cmdline = cmdline_file.read()
+    except (IOError, OSError):
+      # The process no longer exists.
+      continue
+    # Arguments are NUL-terminated. A zombie has an empty cmdline.
+    args = cmdline.split("\0")
+    if args and args[-1] == "":
+      args.pop()
+    processes.append((int(entry), name, args))
+  return processes
+
+
+def _invalidate_user_process_cache():
+  _user_process_cache.clear()
+
+
+def _read_proc_comm(pid):
+  """Returns the command name of 'pid' from /proc, or None if it cannot be read."""
+  try:
+    with open("/proc/%d/comm" % pid) as comm_file:
+      return comm_file.read().rstrip('\n')
+  except (IOError, OSError):
+    return None
+
+
+def _next_poll_interval(interval):
+  """Returns the interval to sleep for after polling with 'interval'."""
+  return min(interval * 1.5, MAX_POLL_INTERVAL_IN_SECONDS)
+
+
+def _pidfd_open(pid):
+  """Returns a file descriptor that becomes readable when the process 'pid' exits, or
+  None if pidfd_open() is not available on this system or the process is gone."""
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    fd = libc.syscall(SYS_PIDFD_OPEN, ctypes.c_int(pid), ctypes.c_uint(0))
+  except (OSError, AttributeError):
+    return None
+  if fd < 0:
+    LOG.info("pidfd_open(%d) failed: %s", pid, os.strerror(ctypes.get_errno()))
+    return None
+  return fd
+
+
+def _probe_coordinator(impalad):
+  """Returns 1 if 'impalad' can evaluate a test query, 0 otherwise."""
+  client = None
+  try:
+    client = impalad.service.create_beeswax_client()
+    result = client.execute("select 1")
+    assert result.success
+    return 1
+  except Exception as e:
+    LOG.info("Coordinator %s is not responsive: %s", impalad.service.hostname, e)
+    return 0
+  finally:
+    if client is not None:
+      client.close()
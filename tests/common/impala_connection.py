@@ -80,6 +80,11 @@ class ImpalaConnection(object):
     string representation of the default value as the value."""
     pass
 
+  @abc.abstractmethod
+  def get_host_port(self):
+    """Returns the 'host:port' of the impalad this connection talks to."""
+    pass
+
   @abc.abstractmethod
   def connect(self):
     """Opens the connection"""
@@ -156,6 +161,9 @@ class BeeswaxConnection(ImpalaConnection):
     if hasattr(tests.common, "current_node"):
       self.set_configuration_option("client_identifier", tests.common.current_node)
 
+  def get_host_port(self):
+    return self.__host_port
+
   def connect(self):
     LOG.info("-- connecting to: %s" % self.__host_port)
     self.__beeswax_client.connect()
@@ -248,6 +256,9 @@ class ImpylaHS2Connection(ImpalaConnection):
     if hasattr(tests.common, "current_node"):
       self.set_configuration_option("client_identifier", tests.common.current_node)
 
+  def get_host_port(self):
+    return self.__host_port
+
   def connect(self):
     LOG.info("-- connecting to {0} with impyla".format(self.__host_port))
     host, port = self.__host_port.split(":")
@@ -17,6 +17,8 @@
 #
 # The base class that should be used for almost all Impala tests
 
+import codecs
+import copy
 import grp
 import logging
 import os
@@ -25,11 +27,15 @@ import pwd
 import pytest
 import re
 import shutil
+import stat
 import subprocess
 import tempfile
 import time
+from collections import OrderedDict
 from functools import wraps
 from getpass import getuser
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
 from random import choice
 from subprocess import check_call
 
@@ -78,6 +84,7 @@ from tests.util.thrift_util import create_transport
 
 # Imports required for Hive Metastore Client
 from hive_metastore import ThriftHiveMetastore
+from hive_metastore.ttypes import DropPartitionsRequest, RequestPartsSpec
 from thrift.protocol import TBinaryProtocol
 
 # Initializing the logger before conditional imports, since we will need it
@@ -103,6 +110,15 @@ HDFS_CONF = HdfsConfig(pytest.config.option.minicluster_xml_conf)
 TARGET_FILESYSTEM = os.getenv("TARGET_FILESYSTEM") or "hdfs"
 IMPALA_HOME = os.getenv("IMPALA_HOME")
 EE_TEST_LOGS_DIR = os.getenv("IMPALA_EE_TEST_LOGS_DIR")
+# The user running the tests and its primary group, used to fill in $USER and
+# $GROUP_NAME in test files. These don't change while the tests run, so they are only
+# looked up once.
+CURRENT_USER = getuser()
+try:
+  CURRENT_USER_GROUP = grp.getgrgid(pwd.getpwnam(CURRENT_USER).pw_gid).gr_name
+except KeyError, e:
+  LOG.error("Unable to find the primary group of %s: %s", CURRENT_USER, e)
+  CURRENT_USER_GROUP = None
 # Match any SET statement. Assume that query options' names
 # only contain alphabets, underscores and digits after position 1.
 # The statement may include SQL line comments starting with --, which we need to
@@ -110,9 +126,107 @@ EE_TEST_LOGS_DIR = os.getenv("IMPALA_EE_TEST_LOGS_DIR")
 COMMENT_LINES_REGEX = r'(?:\s*--.*\n)*'
 SET_PATTERN = re.compile(
     COMMENT_LINES_REGEX + r'\s*set\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=*', re.I)
+# Like SET_PATTERN, but finds the SET statements among multiple ';'-separated statements.
+# Statements are split at every ';', even one inside a comment, so the comment lines
+# before a SET must not span a ';' either.
+SET_STATEMENTS_PATTERN = re.compile(
+    r'(?:^|;)(?:\s*--[^;\n]*\n)*\s*set\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=*', re.I)
+# (regex, common prefix) for a set of placeholder names, keyed by the sorted tuple of
+# names. The regex matches any of the names. Used by _substitute_placeholders().
+_PLACEHOLDER_REGEXES = {}
+
+
+def _substitute_placeholders(text, replacements):
+  """Replaces every occurrence of a key of the dict 'replacements' (e.g. '$NAMENODE') in
+  'text' with the corresponding value, scanning 'text' only once."""
+  if not replacements:
+    return text
+  names = tuple(sorted(replacements))
+  cached = _PLACEHOLDER_REGEXES.get(names)
+  if cached is None:
+    # Try longer names first so that a name is never cut short by one of its prefixes.
+    regex = re.compile('|'.join(
+        re.escape(name) for name in sorted(names, key=len, reverse=True)))
+    cached = (regex, os.path.commonprefix(names))
+    _PLACEHOLDER_REGEXES[names] = cached
+  regex, prefix = cached
+  # Most sections contain no placeholders at all, e.g. no '$' sigil. A substring check
+  # is much cheaper than running the regex.
+  if prefix and prefix not in text:
+    return text
+  return regex.sub(lambda match: replacements[match.group(0)], text)
+
+
+# Maps '\n' to None for unicode.translate(), which deletes it.
+_NEWLINE_DELETION_TABLE = {ord('\n'): None}
+
+
+def _remove_newlines(text):
+  """Returns 'text' with all newlines removed, in a single pass."""
+  if isinstance(text, unicode):
+    return text.translate(_NEWLINE_DELETION_TABLE)
+  return text.translate(None, '\n')
+
+
+# Matches a command in a SETUP section of a test file, capturing the command and the
+# name of the table it applies to.
+SETUP_COMMAND_PATTERN = re.compile(r'^\s*(RESET|DROP PARTITIONS)\s+(\S.*?)\s*$')
+
+# Target filesystems that HBase tables can't be tested on.
+FILESYSTEMS_WITHOUT_HBASE = frozenset(['s3', 'isilon', 'local', 'abfs', 'adls'])
+
+# Placeholders that the keys of the 'test_file_vars' argument of run_test_case() must not
+# use.
+_RESERVED_KEYWORDS = frozenset(["$DATABASE", "$FILESYSTEM_PREFIX", "$GROUP_NAME",
+    "$IMPALA_HOME", "$NAMENODE", "$QUERY", "$SECONDARY_FILESYSTEM", "$USER"])
+
+# Maximum number of idle clients kept by ImpalaTestSuite._get_or_create_client().
+MAX_POOLED_CLIENTS = 16
+
+# Maximum number of partitions dropped by one Hive Metastore RPC in a DROP PARTITIONS
+# command of a SETUP section.
+HIVE_PARTITION_BATCH_SIZE = 500
+
+# Maximum number of log files whose match counts are cached for
+# ImpalaTestSuite.assert_log_contains().
+MAX_CACHED_LOG_FILES = 4
+
+# Maximum number of tables that ImpalaTestSuite.clone_tables() clones at the same time.
+MAX_PARALLEL_TABLE_CLONES = 8
+
+# Maximum number of parsed test files kept by ImpalaTestSuite.load_query_test_file().
+MAX_CACHED_TEST_FILES = 128
+
 
 # Base class for Impala tests. All impala test cases should inherit from this class
 class ImpalaTestSuite(BaseTestSuite):
+  # Default query options of each impalad, keyed by (connection class, host:port) and
+  # storing dicts with upper case option names. Shared by all test classes.
+  _default_query_options_cache = {}
+  # Clients handed out by _get_or_create_client(), keyed by (user, protocol, host:port)
+  # in least recently used order.
+  _client_pool = OrderedDict()
+  # Objects returned by create_impala_service() and create_hdfs_client(), keyed by the
+  # addresses they were created for. They hold no connection state, so all test classes
+  # can share them.
+  _impala_service_cache = {}
+  _hdfs_client_cache = {}
+  # (mtime, sections) of files parsed by load_query_test_file(), keyed by (path, valid
+  # section names, encoding) in least recently used order.
+  _test_file_cache = OrderedDict()
+  # Match counts of log files read by assert_log_contains(), keyed by path in least
+  # recently used order. Values are ((st_dev, st_ino), offset, {regex: count}), where the
+  # counts are over the complete lines before 'offset'. See __count_log_matches().
+  _log_match_counts = OrderedDict()
+  # Maps log file paths to ((st_dev, st_ino, symlink mtime), resolved path). See
+  # __resolve_log_file_path().
+  _log_file_realpaths = {}
+  # (option value, dict) for the workload_exploration_strategy option. See
+  # __get_workload_strategies().
+  _workload_strategies = (None, None)
+  # (os.environ, environment for beeline) as of the last call of __get_beeline_env().
+  _beeline_env = (None, None)
+
   @classmethod
   def add_test_dimensions(cls):
     """
@@ -156,9 +270,9 @@ class ImpalaTestSuite(BaseTestSuite):
       # HS2 connection can fail for benign reasons, e.g. running with unsupported auth.
       LOG.info("HS2 connection setup failed, continuing...: {0}", e)
 
-
-    # Default query options are populated on demand.
-    cls.default_query_options = {}
+    # Default query options are populated on demand. They are reset here because custom
+    # cluster tests restart the cluster with different defaults before calling this.
+    ImpalaTestSuite._default_query_options_cache.clear()
 
     cls.impalad_test_service = cls.create_impala_service()
     cls.hdfs_client = cls.create_hdfs_client()
@@ -184,6 +298,7 @@ class ImpalaTestSuite(BaseTestSuite):
       cls.client.close()
     if cls.hs2_client:
       cls.hs2_client.close()
+    cls._close_pooled_clients()
 
   @classmethod
   def create_impala_client(cls, host_port=None, protocol='beeswax'):
@@ -194,6 +309,39 @@ class ImpalaTestSuite(BaseTestSuite):
     client.connect()
     return client
 
+  @classmethod
+  def _get_or_create_client(cls, user, protocol, host_port=None):
+    """Returns a client connected to 'host_port' (or the default impalad for 'protocol')
+    for running queries as 'user'. Clients are pooled so that switching users does not
+    need a new connection each time. A pooled client is reset to the default database
+    before it is handed out again, which also checks that its connection still works."""
+    if host_port is None:
+      host_port = cls.__get_default_host_port(protocol)
+    key = (user, protocol, host_port)
+    client = ImpalaTestSuite._client_pool.pop(key, None)
+    if client is not None:
+      try:
+        client.clear_configuration()
+        client.execute("use default", user=user)
+      except Exception as e:
+        LOG.info("Discarding pooled client %s: %s", key, e)
+        client.close()
+        client = None
+    if client is None:
+      client = cls.create_impala_client(host_port, protocol=protocol)
+    ImpalaTestSuite._client_pool[key] = client
+    while len(ImpalaTestSuite._client_pool) > MAX_POOLED_CLIENTS:
+      _, evicted_client = ImpalaTestSuite._client_pool.popitem(last=False)
+      evicted_client.close()
+    return client
+
+  @classmethod
+  def _close_pooled_clients(cls):
+    """Closes all clients created by _get_or_create_client()."""
+    while ImpalaTestSuite._client_pool:
+      _, client = ImpalaTestSuite._client_pool.popitem()
+      client.close()
+
   @classmethod
   def __get_default_host_port(cls, protocol):
     if protocol == 'beeswax':
@@ -217,16 +365,26 @@ class ImpalaTestSuite(BaseTestSuite):
 
   @classmethod
   def create_impala_service(cls, host_port=IMPALAD, webserver_port=25000):
-    host, port = host_port.split(':')
-    return ImpaladService(host, beeswax_port=port, webserver_port=webserver_port)
+    key = (host_port, webserver_port)
+    impala_service = ImpalaTestSuite._impala_service_cache.get(key)
+    if impala_service is None:
+      host, port = host_port.split(':')
+      impala_service = ImpaladService(host, beeswax_port=port,
+          webserver_port=webserver_port)
+      ImpalaTestSuite._impala_service_cache[key] = impala_service
+    return impala_service
 
   @classmethod
   def create_hdfs_client(cls):
-    if pytest.config.option.namenode_http_address is None:
-      hdfs_client = get_hdfs_client_from_conf(HDFS_CONF)
-    else:
-      host, port = pytest.config.option.namenode_http_address.split(":")
-      hdfs_client =  get_hdfs_client(host, port)
+    namenode_http_address = pytest.config.option.namenode_http_address
+    hdfs_client = ImpalaTestSuite._hdfs_client_cache.get(namenode_http_address)
+    if hdfs_client is None:
+      if namenode_http_address is None:
+        hdfs_client = get_hdfs_client_from_conf(HDFS_CONF)
+      else:
+        host, port = namenode_http_address.split(":")
+        hdfs_client = get_hdfs_client(host, port)
+      ImpalaTestSuite._hdfs_client_cache[namenode_http_address] = hdfs_client
     return hdfs_client
 
   @classmethod
@@ -241,21 +399,30 @@ class ImpalaTestSuite(BaseTestSuite):
     cls.client.set_configuration({'sync_ddl': sync_ddl})
     cls.client.execute("drop database if exists `" + db_name + "` cascade")
 
+  @classmethod
+  def __get_default_query_options(cls, impalad_client):
+    """Returns the default query options of the impalad that 'impalad_client' is
+    connected to, with upper case option names. Fetched once per impalad and protocol."""
+    key = (type(impalad_client), impalad_client.get_host_port())
+    default_query_options = ImpalaTestSuite._default_query_options_cache.get(key)
+    if default_query_options is None:
+      default_query_options = dict((name.upper(), value) for name, value
+          in impalad_client.get_default_configuration().iteritems())
+      ImpalaTestSuite._default_query_options_cache[key] = default_query_options
+    return default_query_options
+
   def __restore_query_options(self, query_options_changed, impalad_client):
     """
-    Restore the list of modified query options to their default values.
+    Restore the list of modified query options to their default values. Callers should
+    skip this if no query options were modified, so that no defaults are fetched.
     """
-    # Populate the default query option if it's empty.
-    if not self.default_query_options:
-      query_options = impalad_client.get_default_configuration()
-      for key, value in query_options.iteritems():
-        self.default_query_options[key.upper()] = value
-    # Restore all the changed query options.
-    for query_option in query_options_changed:
-      query_option = query_option.upper()
-      if not query_option in self.default_query_options:
+    default_query_options = self.__get_default_query_options(impalad_client)
+    # Restore all the changed query options, once each even if a test set one of them
+    # several times.
+    for query_option in set(name.upper() for name in query_options_changed):
+      if not query_option in default_query_options:
         continue
-      default_val = self.default_query_options[query_option]
+      default_val = default_query_options[query_option]
       query_str = 'SET ' + query_option + '="' + default_val + '"'
       try:
         impalad_client.execute(query_str)
@@ -277,25 +444,21 @@ class ImpalaTestSuite(BaseTestSuite):
     for idx, fs in enumerate(fieldSchemas):
       fields_dict[fs.name.lower()] = idx
 
-    rows = exec_result.get_data().split('\n')
-    rows.pop()
+    # Every row but the last is a partition. The last one holds the totals.
+    rows = exec_result.data[:-1]
     fields_idx = []
     for fn in include_fields:
       fn = fn.lower()
       assert fn in fields_dict, 'Invalid field: %s' % fn
       fields_idx.append(fields_dict[fn])
 
-    result = []
-    for row in rows:
-      fields = row.split('\t')
-      if not fields_idx:
-        result_fields = fields
-      else:
-        result_fields = []
-        for i in fields_idx:
-          result_fields.append(fields[i])
-      result.append(tuple(result_fields))
-    return result
+    if not fields_idx:
+      return [tuple(row.split('\t')) for row in rows]
+    get_fields = itemgetter(*fields_idx)
+    if len(fields_idx) == 1:
+      # itemgetter() with a single index returns the field itself, not a tuple.
+      return [(get_fields(row.split('\t')),) for row in rows]
+    return [get_fields(row.split('\t')) for row in rows]
 
   def __verify_exceptions(self, expected_strs, actual_str, use_db):
     """
@@ -303,17 +466,16 @@ class ImpalaTestSuite(BaseTestSuite):
     * A row_regex: line that matches the actual exception string 'actual_str'
     * A substring of the actual exception string 'actual_str'.
     """
-    actual_str = actual_str.replace('\n', '')
+    actual_str = _remove_newlines(actual_str)
+    # In error messages, some paths are always qualified and some are not.
+    # So, allow both $NAMENODE and $FILESYSTEM_PREFIX to be used in CATCH.
+    replacements = {'$FILESYSTEM_PREFIX': FILESYSTEM_PREFIX, '$NAMENODE': NAMENODE,
+                    '$IMPALA_HOME': IMPALA_HOME}
+    if use_db: replacements['$DATABASE'] = use_db
     for expected_str in expected_strs:
-      # In error messages, some paths are always qualified and some are not.
-      # So, allow both $NAMENODE and $FILESYSTEM_PREFIX to be used in CATCH.
-      expected_str = expected_str.strip() \
-          .replace('$FILESYSTEM_PREFIX', FILESYSTEM_PREFIX) \
-          .replace('$NAMENODE', NAMENODE) \
-          .replace('$IMPALA_HOME', IMPALA_HOME)
-      if use_db: expected_str = expected_str.replace('$DATABASE', use_db)
+      expected_str = _substitute_placeholders(expected_str.strip(), replacements)
       # Strip newlines so we can split error message into multiple lines
-      expected_str = expected_str.replace('\n', '')
+      expected_str = _remove_newlines(expected_str)
       expected_regex = try_compile_regex(expected_str)
       if expected_regex:
         if expected_regex.match(actual_str): return
@@ -330,16 +492,15 @@ class ImpalaTestSuite(BaseTestSuite):
       actual values are easily compared.
     """
     replace_filenames_with_placeholder = True
+    replacements = {'$NAMENODE': NAMENODE, '$IMPALA_HOME': IMPALA_HOME,
+                    '$USER': CURRENT_USER}
+    if use_db: replacements['$DATABASE'] = use_db
     for section_name in ('RESULTS', 'DBAPI_RESULTS', 'ERRORS'):
       if section_name in test_section:
         if "$NAMENODE" in test_section[section_name]:
           replace_filenames_with_placeholder = False
-        test_section[section_name] = test_section[section_name] \
-                                     .replace('$NAMENODE', NAMENODE) \
-                                     .replace('$IMPALA_HOME', IMPALA_HOME) \
-                                     .replace('$USER', getuser())
-        if use_db:
-          test_section[section_name] = test_section[section_name].replace('$DATABASE', use_db)
+        test_section[section_name] = _substitute_placeholders(
+            test_section[section_name], replacements)
     result_section, type_section = 'RESULTS', 'TYPES'
     if vector.get_value('protocol') == 'hs2':
       if 'DBAPI_RESULTS' in test_section:
@@ -376,34 +537,66 @@ class ImpalaTestSuite(BaseTestSuite):
     latin). If not set, the default system encoding will be used.
     If a dict 'test_file_vars' is provided, then all keys will be replaced with their
     values in queries before they are executed. Callers need to avoid using reserved key
-    names, see 'reserved_keywords' below.
+    names, see '_RESERVED_KEYWORDS'.
     """
     table_format_info = vector.get_value('table_format')
     exec_options = vector.get_value('exec_option')
     protocol = vector.get_value('protocol')
 
-    # Resolve the current user's primary group name.
-    group_id = pwd.getpwnam(getuser()).pw_gid
-    group_name = grp.getgrgid(group_id).gr_name
+    # Placeholders that can be used in SHELL, QUERY and CATCH sections respectively.
+    shell_replacements = {'$FILESYSTEM_PREFIX': FILESYSTEM_PREFIX,
+                          '$IMPALA_HOME': IMPALA_HOME}
+    query_replacements = {'$IMPALA_HOME': IMPALA_HOME,
+                          '$FILESYSTEM_PREFIX': FILESYSTEM_PREFIX,
+                          '$SECONDARY_FILESYSTEM':
+                              os.getenv("SECONDARY_FILESYSTEM") or str(),
+                          '$USER': CURRENT_USER}
+    if CURRENT_USER_GROUP is not None:
+      query_replacements['$GROUP_NAME'] = CURRENT_USER_GROUP
+    if use_db:
+      shell_replacements['$DATABASE'] = use_db
+      query_replacements['$DATABASE'] = use_db
+    catch_replacements = {'$FILESYSTEM_PREFIX': FILESYSTEM_PREFIX, '$NAMENODE': NAMENODE,
+                          '$IMPALA_HOME': IMPALA_HOME}
 
-    target_impalad_clients = list()
     if multiple_impalad:
-      target_impalad_clients =\
-          [ImpalaTestSuite.create_impala_client(host_port, protocol=protocol)
-           for host_port in self.__get_cluster_host_ports(protocol)]
+      cluster_host_ports = self.__get_cluster_host_ports(protocol)
+      default_impalad_client = None
+    elif protocol == 'beeswax':
+      default_impalad_client = self.client
     else:
-      if protocol == 'beeswax':
-        target_impalad_clients = [self.client]
-      else:
-        assert protocol == 'hs2'
-        target_impalad_clients = [self.hs2_client]
+      assert protocol == 'hs2'
+      default_impalad_client = self.hs2_client
 
     # Change the database to reflect the file_format, compression codec etc, or the
-    # user specified database for all targeted impalad.
-    for impalad_client in target_impalad_clients:
+    # user specified database for all targeted impalad. With multiple_impalad, clients
+    # are only connected and set up once a test section picks their impalad.
+    def set_up_client(impalad_client):
       ImpalaTestSuite.change_database(impalad_client,
           table_format_info, use_db, pytest.config.option.scale_factor)
       impalad_client.set_configuration(exec_options)
+    if default_impalad_client is not None:
+      set_up_client(default_impalad_client)
+    clients_by_host_port = {}
+
+    def pick_target_impalad_client():
+      if default_impalad_client is not None:
+        return default_impalad_client
+      host_port = choice(cluster_host_ports)
+      impalad_client = clients_by_host_port.get(host_port)
+      if impalad_client is None:
+        impalad_client = self._get_or_create_client(None, protocol, host_port)
+        set_up_client(impalad_client)
+        clients_by_host_port[host_port] = impalad_client
+      return impalad_client
+
+    if test_file_vars:
+      for key in test_file_vars:
+        if key in _RESERVED_KEYWORDS:
+          raise RuntimeError("Key {0} is reserved".format(key))
+
+    # Looked up once here instead of by every row.decode(encoding) call.
+    decode = codecs.getdecoder(encoding) if encoding else None
 
     sections = self.load_query_test_file(self.get_workload(), test_file_name,
         encoding=encoding)
@@ -411,39 +604,25 @@ class ImpalaTestSuite(BaseTestSuite):
       if 'SHELL' in test_section:
         assert len(test_section) == 1, \
           "SHELL test sections can't contain other sections"
-        cmd = test_section['SHELL']\
-          .replace('$FILESYSTEM_PREFIX', FILESYSTEM_PREFIX)\
-          .replace('$IMPALA_HOME', IMPALA_HOME)
-        if use_db: cmd = cmd.replace('$DATABASE', use_db)
+        cmd = _substitute_placeholders(test_section['SHELL'], shell_replacements)
         LOG.info("Shell command: " + cmd)
         check_call(cmd, shell=True)
         continue
 
       if 'QUERY' not in test_section:
-        assert 0, 'Error in test file %s. Test cases require a -- QUERY section.\n%s' %\
-            (test_file_name, pprint.pformat(test_section))
+        raise AssertionError(
+            'Error in test file %s. Test cases require a -- QUERY section.\n%s' %
+            (test_file_name, pprint.pformat(test_section)))
 
       if 'SETUP' in test_section:
         self.execute_test_case_setup(test_section['SETUP'], table_format_info)
 
       # TODO: support running query tests against different scale factors
-      query = QueryTestSectionReader.build_query(test_section['QUERY']
-          .replace('$GROUP_NAME', group_name)
-          .replace('$IMPALA_HOME', IMPALA_HOME)
-          .replace('$FILESYSTEM_PREFIX', FILESYSTEM_PREFIX)
-          .replace('$SECONDARY_FILESYSTEM', os.getenv("SECONDARY_FILESYSTEM") or str())
-          .replace('$USER', getuser()))
-      if use_db: query = query.replace('$DATABASE', use_db)
-
-      reserved_keywords = ["$DATABASE", "$FILESYSTEM_PREFIX", "$GROUP_NAME",
-                           "$IMPALA_HOME", "$NAMENODE", "$QUERY", "$SECONDARY_FILESYSTEM",
-                           "$USER"]
+      query = QueryTestSectionReader.build_query(
+          _substitute_placeholders(test_section['QUERY'], query_replacements))
 
       if test_file_vars:
-        for key, value in test_file_vars.iteritems():
-          if key in reserved_keywords:
-            raise RuntimeError("Key {0} is reserved".format(key))
-          query = query.replace(key, value)
+        query = _substitute_placeholders(query, test_file_vars)
 
       if 'QUERY_NAME' in test_section:
         LOG.info('Query Name: \n%s\n' % test_section['QUERY_NAME'])
@@ -453,22 +632,22 @@ class ImpalaTestSuite(BaseTestSuite):
       # statements before a query executes, but it is not limited to that.
       # TODO: consider supporting result verification of all queries in the future
       result = None
-      target_impalad_client = choice(target_impalad_clients)
+      target_impalad_client = pick_target_impalad_client()
       query_options_changed = []
       try:
         user = None
         if 'USER' in test_section:
-          # Create a new client so the session will use the new username.
+          # Use a separate client so the session will use the new username.
           user = test_section['USER'].strip()
-          target_impalad_client = self.create_impala_client(protocol=protocol)
+          target_impalad_client = self._get_or_create_client(user, protocol)
+        for set_pattern_match in SET_STATEMENTS_PATTERN.finditer(query):
+          query_option = set_pattern_match.group(1)
+          query_options_changed.append(query_option)
+          assert query_option not in vector.get_value("exec_option"), \
+              "%s cannot be set in  the '.test' file since it is in the test vector. " \
+              "Consider deepcopy()-ing the vector and removing this option in the " \
+              "python test." % query_option
         for query in query.split(';'):
-          set_pattern_match = SET_PATTERN.match(query)
-          if set_pattern_match != None:
-            query_options_changed.append(set_pattern_match.groups()[0])
-            assert set_pattern_match.groups()[0] not in vector.get_value("exec_option"), \
-                "%s cannot be set in  the '.test' file since it is in the test vector. " \
-                "Consider deepcopy()-ing the vector and removing this option in the " \
-                "python test." % set_pattern_match.groups()[0]
           result = self.__execute_query(target_impalad_client, query, user=user)
       except Exception as e:
         if 'CATCH' in test_section:
@@ -476,21 +655,19 @@ class ImpalaTestSuite(BaseTestSuite):
           continue
         raise
       finally:
-        if len(query_options_changed) > 0:
+        if query_options_changed:
           self.__restore_query_options(query_options_changed, target_impalad_client)
 
       if 'CATCH' in test_section and '__NO_ERROR__' not in test_section['CATCH']:
-        expected_str = " or ".join(test_section['CATCH']).strip() \
-          .replace('$FILESYSTEM_PREFIX', FILESYSTEM_PREFIX) \
-          .replace('$NAMENODE', NAMENODE) \
-          .replace('$IMPALA_HOME', IMPALA_HOME)
+        expected_str = _substitute_placeholders(
+            " or ".join(test_section['CATCH']).strip(), catch_replacements)
         assert False, "Expected exception: %s" % expected_str
 
       assert result is not None
       assert result.success
 
       # Decode the results read back if the data is stored with a specific encoding.
-      if encoding: result.data = [row.decode(encoding) for row in result.data]
+      if decode: result.data = [decode(row)[0] for row in result.data]
       # Replace $NAMENODE in the expected results with the actual namenode URI.
       if 'RESULTS' in test_section:
         # Combining 'RESULTS' with 'DML_RESULTS" is currently unsupported because
@@ -548,21 +725,22 @@ class ImpalaTestSuite(BaseTestSuite):
     RESET <table name> - Drop and recreate the table
     DROP PARTITIONS <table name> - Drop all partitions from the table
     """
+    setup_actions = {'RESET': self.__reset_table,
+                     'DROP PARTITIONS': self.__drop_partitions}
     setup_section = QueryTestSectionReader.build_query(setup_section)
+    # Tables modified in the metastore, in order, without duplicates.
+    tables_to_invalidate = []
     for row in setup_section.split('\n'):
-      row = row.lstrip()
-      if row.startswith('RESET'):
-        db_name, table_name = QueryTestSectionReader.get_table_name_components(\
-          table_format, row.split('RESET')[1])
-        self.__reset_table(db_name, table_name)
-        self.client.execute("invalidate metadata " + db_name + "." + table_name)
-      elif row.startswith('DROP PARTITIONS'):
-        db_name, table_name = QueryTestSectionReader.get_table_name_components(\
-          table_format, row.split('DROP PARTITIONS')[1])
-        self.__drop_partitions(db_name, table_name)
-        self.client.execute("invalidate metadata " + db_name + "." + table_name)
-      else:
-        assert False, 'Unsupported setup command: %s' % row
+      match = SETUP_COMMAND_PATTERN.match(row)
+      assert match is not None, 'Unsupported setup command: %s' % row
+      command, table = match.groups()
+      db_name, table_name = QueryTestSectionReader.get_table_name_components(
+          table_format, table)
+      setup_actions[command](db_name, table_name)
+      if (db_name, table_name) not in tables_to_invalidate:
+        tables_to_invalidate.append((db_name, table_name))
+    for db_name, table_name in tables_to_invalidate:
+      self.client.execute("invalidate metadata " + db_name + "." + table_name)
 
   @classmethod
   def change_database(cls, impala_client, table_format=None,
@@ -631,6 +809,33 @@ class ImpalaTestSuite(BaseTestSuite):
   def execute_query(self, query, query_options=None):
     return self.__execute_query(self.client, query, query_options)
 
+  @execute_wrapper
+  def execute_queries(self, queries, query_options=None, timeout=300):
+    """Executes 'queries' concurrently and returns their results in the same order.
+    All queries are started before waiting for any of them, so this takes about as long
+    as the slowest query rather than all of them added up. The queries must not depend on
+    each other. Raises if a query fails or does not finish within 'timeout' seconds."""
+    if query_options is not None: self.client.set_configuration(query_options)
+    handles = []
+    try:
+      for query in queries:
+        handles.append(self.client.execute_async(query.strip()))
+      results = []
+      for handle in handles:
+        # Raises if the query failed.
+        if not self.client.wait_for_finished_timeout(handle, timeout):
+          raise Timeout("Query did not finish within %s seconds: %s"
+                        % (timeout, handle.sql_stmt()))
+        results.append(self.client.fetch(handle.sql_stmt(), handle))
+      return results
+    finally:
+      for handle in handles:
+        try:
+          self.client.close_query(handle)
+        except Exception as e:
+          # Failed queries and inserts are closed already.
+          LOG.info("Error closing query %s: %s", handle.sql_stmt(), e)
+
   def execute_query_using_client(self, client, query, vector):
     self.change_database(client, vector.get_value('table_format'))
     return client.execute(query)
@@ -680,17 +885,42 @@ class ImpalaTestSuite(BaseTestSuite):
     """
     Loads/Reads the specified query test file. Accepts the given section names as valid.
     Uses a default list of valid section names if valid_section_names is None.
+
+    Test files are usually run once per test vector, so parsed files are cached until
+    they are modified. Callers get their own copy of the sections and may modify it. The
+    cache is not used with --update_results.
     """
     test_file_path = os.path.join(WORKLOAD_DIR, workload, 'queries', file_name + '.test')
-    if not os.path.isfile(test_file_path):
+    try:
+      test_file_stat = os.stat(test_file_path)
+    except OSError:
+      test_file_stat = None
+    if test_file_stat is None or not stat.S_ISREG(test_file_stat.st_mode):
       assert False, 'Test file not found: %s' % file_name
-    return parse_query_test_file(test_file_path, valid_section_names, encoding=encoding)
+    if pytest.config.option.update_results:
+      return parse_query_test_file(test_file_path, valid_section_names, encoding=encoding)
+    key = (test_file_path,
+        None if valid_section_names is None else tuple(valid_section_names), encoding)
+    mtime, sections = ImpalaTestSuite._test_file_cache.pop(key, (None, None))
+    if mtime != test_file_stat.st_mtime:
+      mtime = test_file_stat.st_mtime
+      sections = parse_query_test_file(test_file_path, valid_section_names,
+          encoding=encoding)
+    ImpalaTestSuite._test_file_cache[key] = (mtime, sections)
+    while len(ImpalaTestSuite._test_file_cache) > MAX_CACHED_TEST_FILES:
+      ImpalaTestSuite._test_file_cache.popitem(last=False)
+    return copy.deepcopy(sections)
 
   def __drop_partitions(self, db_name, table_name):
     """Drops all partitions in the given table"""
-    for partition in self.hive_client.get_partition_names(db_name, table_name, 0):
-      assert self.hive_client.drop_partition_by_name(db_name, table_name, \
-          partition, True), 'Could not drop partition: %s' % partition
+    partitions = self.hive_client.get_partition_names(db_name, table_name, 0)
+    for i in xrange(0, len(partitions), HIVE_PARTITION_BATCH_SIZE):
+      batch = partitions[i:i + HIVE_PARTITION_BATCH_SIZE]
+      # Fails with a MetaException or NoSuchObjectException if any of the partitions
+      # could not be dropped.
+      self.hive_client.drop_partitions_req(DropPartitionsRequest(dbName=db_name,
+          tblName=table_name, parts=RequestPartsSpec(names=batch), deleteData=True,
+          ifExists=False, needResult=False))
 
   @classmethod
   def __execute_query(cls, impalad_client, query, query_options=None, user=None):
@@ -704,35 +934,138 @@ class ImpalaTestSuite(BaseTestSuite):
     assert table is not None
     self.hive_client.drop_table(db_name, table_name, True)
     self.hive_client.create_table(table)
+    self.__describe_formatted_cache().pop(
+        "%s.%s" % (db_name.lower(), table_name.lower()), None)
 
   def clone_table(self, src_tbl, dst_tbl, recover_partitions, vector):
     src_loc = self._get_table_location(src_tbl, vector)
-    self.client.execute("create external table {0} like {1} location '{2}'"\
+    self.__describe_formatted_cache().pop(dst_tbl.lower(), None)
+    self.__create_table_clone(self.client, src_tbl, src_loc, dst_tbl, recover_partitions)
+
+  def clone_tables(self, clone_specs, vector):
+    """Like clone_table(), but for a list of (src_tbl, dst_tbl, recover_partitions)
+    tuples. The clones are created in parallel, each on its own connection, so no
+    'dst_tbl' may be the 'src_tbl' of another tuple and table names must be qualified
+    with a database."""
+    clones = []
+    for src_tbl, dst_tbl, recover_partitions in clone_specs:
+      clones.append((src_tbl, self._get_table_location(src_tbl, vector), dst_tbl,
+          recover_partitions))
+      self.__describe_formatted_cache().pop(dst_tbl.lower(), None)
+
+    def create_table_clone(clone):
+      client = self.create_impala_client()
+      try:
+        self.__create_table_clone(client, *clone)
+      finally:
+        client.close()
+
+    pool = ThreadPool(processes=max(1, min(len(clones), MAX_PARALLEL_TABLE_CLONES)))
+    try:
+      pool.map(create_table_clone, clones)
+    finally:
+      pool.terminate()
+
+  @classmethod
+  def __create_table_clone(cls, client, src_tbl, src_loc, dst_tbl, recover_partitions):
+    client.execute("create external table {0} like {1} location '{2}'"\
         .format(dst_tbl, src_tbl, src_loc))
     if recover_partitions:
-      self.client.execute("alter table {0} recover partitions".format(dst_tbl))
+      client.execute("alter table {0} recover partitions".format(dst_tbl))
 
   def appx_equals(self, a, b, diff_perc):
     """Returns True if 'a' and 'b' are within 'diff_perc' percent of each other,
     False otherwise. 'diff_perc' must be a float in [0,1]."""
-    if a == b: return True # Avoid division by 0
-    assert abs(a - b) / float(max(a,b)) <= diff_perc
+    if a == b: return True
+    # Multiplying instead of dividing needs no float() conversion and can't divide by 0.
+    assert abs(a - b) <= diff_perc * (a if a > b else b)
 
   def _get_table_location(self, table_name, vector):
     """ Returns the HDFS location of the table """
+    location = self._describe_formatted(table_name, vector).get('Location')
+    # This should never happen.
+    assert location is not None, 'Unable to get location for table: ' + table_name
+    return location
+
+  def _describe_formatted(self, table_name, vector):
+    """Returns the 'Name:' fields of 'describe formatted <table_name>' as a dict from
+    name without the colon to value, e.g. {'Location': 'hdfs://...', ...}. Results for
+    tables with database qualified names are cached for the rest of the test."""
+    # Unqualified names depend on the current database, so they are not cached.
+    cache_key = table_name.lower() if '.' in table_name else None
+    fields = self.__describe_formatted_cache().get(cache_key)
+    if fields is not None:
+      return fields
     result = self.execute_query_using_client(self.client,
         "describe formatted %s" % table_name, vector)
+    fields = {}
     for row in result.data:
-      if 'Location:' in row:
-        return row.split('\t')[1]
-    # This should never happen.
-    assert 0, 'Unable to get location for table: ' + table_name
-
-  def run_stmt_in_hive(self, stmt, username=getuser()):
+      # Field rows look like 'Location:<padding>\t<location>\tNULL'.
+      name, _, rest = row.partition('\t')
+      name = name.rstrip()
+      if name.endswith(':') and not name.startswith('#'):
+        fields.setdefault(name[:-1], rest.partition('\t')[0].strip())
+    if cache_key is not None:
+      self.__describe_formatted_cache()[cache_key] = fields
+    return fields
+
+  def __describe_formatted_cache(self):
+    """Returns the results of _describe_formatted(), keyed by lower case qualified table
+    name. pytest creates a test class instance per test, so the cache only lives as long
+    as a test."""
+    cache = self.__dict__.get('_describe_formatted_cache')
+    if cache is None:
+      cache = self.__dict__['_describe_formatted_cache'] = {}
+    return cache
+
+  def run_stmt_in_hive(self, stmt, username=CURRENT_USER):
     """
     Run a statement in Hive, returning stdout if successful and throwing
     RuntimeError(stderr) if not.
     """
+    call, tmpdir = self.__start_beeline(stmt, username, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    try:
+      # communicate() reads stdout and stderr in chunks as they arrive, and waits for
+      # beeline to exit.
+      (stdout, stderr) = call.communicate()
+      if call.returncode != 0:
+        raise RuntimeError(stderr)
+      return stdout
+    finally:
+      # A failure to clean up must not hide the error from beeline.
+      if tmpdir is not None: shutil.rmtree(tmpdir, ignore_errors=True)
+
+  def run_stmt_in_hive_lines(self, stmt, username=CURRENT_USER):
+    """
+    Like run_stmt_in_hive(), but returns an iterator over the lines of stdout, without
+    line endings, as beeline writes them. This avoids holding large outputs in memory
+    at once. RuntimeError(stderr) is raised at the end if beeline failed.
+    """
+    # stderr goes to a file, so that beeline can't block on a full stderr pipe while
+    # stdout is read.
+    with tempfile.TemporaryFile() as stderr_file:
+      call, tmpdir = self.__start_beeline(stmt, username, stdout=subprocess.PIPE,
+          stderr=stderr_file)
+      try:
+        for line in call.stdout:
+          yield line.rstrip('\n')
+        call.wait()
+        if call.returncode != 0:
+          stderr_file.seek(0)
+          raise RuntimeError(stderr_file.read())
+      finally:
+        if call.poll() is None:
+          # The caller stopped iterating early.
+          call.kill()
+          call.wait()
+        call.stdout.close()
+        # A failure to clean up must not hide the error from beeline.
+        if tmpdir is not None: shutil.rmtree(tmpdir, ignore_errors=True)
+
+  def __start_beeline(self, stmt, username, stdout, stderr):
+    """Starts beeline to run 'stmt' in Hive as 'username'. Returns the Popen object and
+    a temporary directory that the caller must remove after beeline exited, or None."""
     # When HiveServer2 is configured to use "local" mode (i.e., MR jobs are run
     # in-process rather than on YARN), Hadoop's LocalDistributedCacheManager has a
     # race, wherein it tires to localize jars into
@@ -750,35 +1083,44 @@ class ImpalaTestSuite(BaseTestSuite):
       tmpdir = tempfile.mkdtemp(prefix="impala-tests-")
       beeline_opts += ['--hiveconf', 'mapreduce.cluster.local.dir={0}'.format(tmpdir)]
     try:
+      env = self.__get_beeline_env()
+      # Beeline in Hive 2.1 will read from stdin even when "-e"
+      # is specified; explicitly make sure there's nothing to
+      # read to avoid hanging, especially when running interactively
+      # with py.test. The child keeps its own copy of the descriptor.
+      with open(os.devnull) as devnull:
+        call = subprocess.Popen(
+            ['beeline',
+             '--outputformat=csv2',
+             '-u', 'jdbc:hive2://' + pytest.config.option.hive_server2,
+             '-n', username,
+             '-e', stmt] + beeline_opts,
+            stdout=stdout,
+            stderr=stderr,
+            stdin=devnull,
+            env=env)
+    except Exception:
+      if tmpdir is not None: shutil.rmtree(tmpdir, ignore_errors=True)
+      raise
+    return call, tmpdir
+
+  @classmethod
+  def __get_beeline_env(cls):
+    """Returns the environment to run beeline with. It is built once and rebuilt only if
+    the environment of this process changed since."""
+    environ, beeline_env = ImpalaTestSuite._beeline_env
+    if environ != os.environ:
+      environ = dict(os.environ)
       # Remove HADOOP_CLASSPATH from environment. Beeline doesn't need it,
       # and doing so avoids Hadoop 3's classpath de-duplication code from
       # placing $HADOOP_CONF_DIR too late in the classpath to get the right
       # log4j configuration file picked up. Some log4j configuration files
       # in Hadoop's jars send logging to stdout, confusing Impala's test
       # framework.
-      env = os.environ.copy()
-      env.pop("HADOOP_CLASSPATH", None)
-      call = subprocess.Popen(
-          ['beeline',
-           '--outputformat=csv2',
-           '-u', 'jdbc:hive2://' + pytest.config.option.hive_server2,
-           '-n', username,
-           '-e', stmt] + beeline_opts,
-          stdout=subprocess.PIPE,
-          stderr=subprocess.PIPE,
-          # Beeline in Hive 2.1 will read from stdin even when "-e"
-          # is specified; explicitly make sure there's nothing to
-          # read to avoid hanging, especially when running interactively
-          # with py.test.
-          stdin=file("/dev/null"),
-          env=env)
-      (stdout, stderr) = call.communicate()
-      call.wait()
-      if call.returncode != 0:
-        raise RuntimeError(stderr)
-      return stdout
-    finally:
-      if tmpdir is not None: shutil.rmtree(tmpdir)
+      beeline_env = dict(environ)
+      beeline_env.pop("HADOOP_CLASSPATH", None)
+      ImpalaTestSuite._beeline_env = (environ, beeline_env)
+    return beeline_env
 
   def hive_partition_names(self, table_name):
     """Find the names of the partitions of a table, as Hive sees them.
@@ -786,8 +1128,10 @@ class ImpalaTestSuite(BaseTestSuite):
     The return format is a list of strings. Each string represents a partition
     value of a given column in a format like 'column1=7/column2=8'.
     """
-    return self.run_stmt_in_hive(
-        'show partitions %s' % table_name).split('\n')[1:-1]
+    lines = self.run_stmt_in_hive_lines('show partitions %s' % table_name)
+    # Skip the header.
+    next(lines, None)
+    return [line for line in lines if line]
 
   @classmethod
   def create_table_info_dimension(cls, exploration_strategy):
@@ -803,12 +1147,10 @@ class ImpalaTestSuite(BaseTestSuite):
       tf_dimensions = load_table_info_dimension(cls.get_workload(), exploration_strategy)
     # If 'skip_hbase' is specified or the filesystem is isilon, s3 or local, we don't
     # need the hbase dimension.
-    if pytest.config.option.skip_hbase or TARGET_FILESYSTEM.lower() \
-        in ['s3', 'isilon', 'local', 'abfs', 'adls']:
-      for tf_dimension in tf_dimensions:
-        if tf_dimension.value.file_format == "hbase":
-          tf_dimensions.remove(tf_dimension)
-          break
+    if pytest.config.option.skip_hbase or \
+        TARGET_FILESYSTEM.lower() in FILESYSTEMS_WITHOUT_HBASE:
+      tf_dimensions[:] = [tf_dimension for tf_dimension in tf_dimensions
+                          if tf_dimension.value.file_format != "hbase"]
     return tf_dimensions
 
   @classmethod
@@ -829,24 +1171,114 @@ class ImpalaTestSuite(BaseTestSuite):
   def exploration_strategy(cls):
     default_strategy = pytest.config.option.exploration_strategy
     if pytest.config.option.workload_exploration_strategy:
-      workload_strategies = pytest.config.option.workload_exploration_strategy.split(',')
-      for workload_strategy in workload_strategies:
+      return cls.__get_workload_strategies().get(cls.get_workload(), default_strategy)
+    return default_strategy
+
+  @classmethod
+  def __get_workload_strategies(cls):
+    """Returns a dict from workload to exploration strategy, parsed from the
+    'workload_exploration_strategy' option. The parsed dict is kept until the option
+    changes. If a workload is listed more than once, the first strategy wins."""
+    option = pytest.config.option.workload_exploration_strategy
+    if ImpalaTestSuite._workload_strategies[0] != option:
+      workload_strategies = {}
+      for workload_strategy in option.split(','):
         workload_strategy = workload_strategy.split(':')
         if len(workload_strategy) != 2:
           raise ValueError, 'Invalid workload:strategy format: %s' % workload_strategy
-        if cls.get_workload() == workload_strategy[0]:
-          return workload_strategy[1]
-    return default_strategy
+        workload_strategies.setdefault(workload_strategy[0], workload_strategy[1])
+      ImpalaTestSuite._workload_strategies = (option, workload_strategies)
+    return ImpalaTestSuite._workload_strategies[1]
+
+  @classmethod
+  def __resolve_log_file_path(cls, log_file_path):
+    """Returns os.path.realpath(log_file_path). Resolves symlinks only once for as long
+    as 'log_file_path' is the same file or symlink. glog replaces the symlink when a
+    daemon starts a new log file."""
+    link_stat = os.lstat(log_file_path)
+    link_id = (link_stat.st_dev, link_stat.st_ino,
+        link_stat.st_mtime if stat.S_ISLNK(link_stat.st_mode) else None)
+    cached_link_id, realpath = ImpalaTestSuite._log_file_realpaths.get(log_file_path,
+        (None, None))
+    if cached_link_id != link_id:
+      realpath = os.path.realpath(log_file_path)
+      ImpalaTestSuite._log_file_realpaths[log_file_path] = (link_id, realpath)
+    return realpath
+
+  @classmethod
+  def __count_log_matches(cls, log_file_path, line_regexes):
+    """Returns a dict from each regex in 'line_regexes' to the number of lines of the log
+    file at 'log_file_path' with a substring matching it. The counts are cached along
+    with the offset up to which the file was read, so a repeated call only reads what
+    was appended to the file since. A regex that was not counted before needs one more
+    pass over the part of the file that was already read."""
+    log_file_stat = os.stat(log_file_path)
+    file_id = (log_file_stat.st_dev, log_file_stat.st_ino)
+    cached = ImpalaTestSuite._log_match_counts.pop(log_file_path, None)
+    if cached is None or cached[0] != file_id or cached[1] > log_file_stat.st_size:
+      # Not read before, or the file was replaced or truncated.
+      cached = (file_id, 0, {})
+    _, offset, counts = cached
+    new_patterns = [(regex, re.compile(regex)) for regex in set(line_regexes)
+                    if regex not in counts]
+    for regex, _ in new_patterns:
+      counts[regex] = 0
+    # The appended lines are searched for all cached regexes, since they all get counted
+    # up to the new offset.
+    patterns = [(regex, re.compile(regex)) for regex in counts]
+    # A last line without a newline yet is counted, but not cached, since it may still
+    # grow.
+    incomplete_line_counts = {}
+    with open(log_file_path) as log_file:
+      if new_patterns:
+        while log_file.tell() < offset:
+          line = log_file.readline()
+          for regex, pattern in new_patterns:
+            if pattern.search(line):
+              counts[regex] += 1
+      else:
+        log_file.seek(offset)
+      for line in iter(log_file.readline, ''):
+        if not line.endswith('\n'):
+          for regex, pattern in patterns:
+            if pattern.search(line):
+              incomplete_line_counts[regex] = 1
+          break
+        offset += len(line)
+        for regex, pattern in patterns:
+          if pattern.search(line):
+            counts[regex] += 1
+    ImpalaTestSuite._log_match_counts[log_file_path] = (file_id, offset, counts)
+    while len(ImpalaTestSuite._log_match_counts) > MAX_CACHED_LOG_FILES:
+      ImpalaTestSuite._log_match_counts.popitem(last=False)
+    result = {}
+    for regex in line_regexes:
+      result[regex] = counts[regex] + incomplete_line_counts.get(regex, 0)
+    return result
+
+  @classmethod
+  def __read_last_log_line(cls, log_file_path):
+    """Returns the last line of the log file at 'log_file_path', or None if it is
+    empty."""
+    line = None
+    with open(log_file_path) as log_file:
+      for line in log_file:
+        pass
+    return line
 
   def wait_for_state(self, handle, expected_state, timeout):
     """Waits for the given 'query_handle' to reach the 'expected_state'. If it does not
     reach the given state within 'timeout' seconds, the method throws an AssertionError.
     """
     start_time = time.time()
+    # Poll often at first so that short waits return quickly, then back off so that long
+    # waits don't make needless RPCs.
+    interval = 0.02
     actual_state = self.client.get_state(handle)
     while actual_state != expected_state and time.time() - start_time < timeout:
+      time.sleep(interval)
+      interval = min(interval * 1.5, 0.5)
       actual_state = self.client.get_state(handle)
-      time.sleep(0.5)
     if actual_state != expected_state:
       raise Timeout("query '%s' did not reach expected state '%s', last known state '%s'"
                     % (handle.get_handle().id, expected_state, actual_state))
@@ -872,23 +1304,28 @@ class ImpalaTestSuite(BaseTestSuite):
     make sure that log buffering has been disabled, for example by adding
     '-logbuflevel=-1' to the daemon startup options.
     """
-    pattern = re.compile(line_regex)
-    found = 0
+    self.assert_log_contains_many(daemon, level, [(line_regex, expected_count)])
+
+  def assert_log_contains_many(self, daemon, level, expected):
+    """
+    Like assert_log_contains(), but checks a list of (line_regex, expected_count) pairs
+    while reading the log only once.
+    """
     if hasattr(self, "impala_log_dir"):
       log_dir = self.impala_log_dir
     else:
       log_dir = EE_TEST_LOGS_DIR
     log_file_path = os.path.join(log_dir, daemon + "." + level)
     # Resolve symlinks to make finding the file easier.
-    log_file_path = os.path.realpath(log_file_path)
-    with open(log_file_path) as log_file:
-      for line in log_file:
-        if pattern.search(line):
-          found += 1
-    if expected_count == -1:
-      assert found > 0, "Expected at least one line in file %s matching regex '%s'"\
-        ", but found none." % (log_file_path, line_regex)
-    else:
-      assert found == expected_count, "Expected %d lines in file %s matching regex '%s'"\
-        ", but found %d lines. Last line was: \n%s" %\
-        (expected_count, log_file_path, line_regex, found, line)
+    log_file_path = self.__resolve_log_file_path(log_file_path)
+    counts = self.__count_log_matches(log_file_path,
+        [line_regex for line_regex, _ in expected])
+    for line_regex, expected_count in expected:
+      count = counts[line_regex]
+      if expected_count == -1:
+        assert count > 0, "Expected at least one line in file %s matching regex '%s'"\
+          ", but found none." % (log_file_path, line_regex)
+      elif count != expected_count:
+        assert False, "Expected %d lines in file %s matching regex '%s', but found %d "\
+          "lines. Last line was: \n%s" % (expected_count, log_file_path, line_regex,
+          count, self.__read_last_log_line(log_file_path))
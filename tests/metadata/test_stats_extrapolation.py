@@ -53,9 +53,17 @@ class TestStatsExtrapolation(ImpalaTestSuite):
     # we exercise the sampling code paths.
     self.client.execute("set compute_stats_min_sample_size=0")
 
-    # Test partitioned table.
     part_test_tbl = unique_database + ".alltypes"
-    self.clone_table("functional.alltypes", part_test_tbl, True, vector)
+    empty_test_tbl = unique_database + ".empty_tbl"
+    column_subset_tbl = unique_database + ".column_subset"
+    no_column_tbl = unique_database + ".no_columns"
+    # These clones don't depend on each other, so create them together.
+    self.clone_tables([("functional.alltypes", part_test_tbl, True),
+                       ("functional.alltypes", empty_test_tbl, False),
+                       ("functional.alltypes", column_subset_tbl, True),
+                       ("functional.alltypes", no_column_tbl, True)], vector)
+
+    # Test partitioned table.
     # Clone to use as a baseline. We run the regular COMPUTE STATS on this table.
     part_test_tbl_base = unique_database + ".alltypes_base"
     self.clone_table(part_test_tbl, part_test_tbl_base, True, vector)
@@ -85,15 +93,11 @@ class TestStatsExtrapolation(ImpalaTestSuite):
     self.__run_sampling_test(nopart_test_tbl, "", nopart_test_tbl_base, 100, 99)
 
     # Test empty table.
-    empty_test_tbl = unique_database + ".empty_tbl"
-    self.clone_table("functional.alltypes", empty_test_tbl, False, vector)
     self.__set_extrapolation_tblprop(empty_test_tbl)
     self.__run_sampling_test(empty_test_tbl, "", empty_test_tbl, 10, 7)
 
     # Test column subset.
-    column_subset_tbl = unique_database + ".column_subset"
     columns = "(int_col, string_col)"
-    self.clone_table("functional.alltypes", column_subset_tbl, True, vector)
     self.__set_extrapolation_tblprop(column_subset_tbl)
     self.__run_sampling_test(column_subset_tbl, columns, part_test_tbl_base, 1, 3)
     self.__run_sampling_test(column_subset_tbl, columns, part_test_tbl_base, 10, 7)
@@ -101,9 +105,7 @@ class TestStatsExtrapolation(ImpalaTestSuite):
     self.__run_sampling_test(column_subset_tbl, columns, part_test_tbl_base, 100, 99)
 
     # Test no columns.
-    no_column_tbl = unique_database + ".no_columns"
     columns = "()"
-    self.clone_table("functional.alltypes", no_column_tbl, True, vector)
     self.__set_extrapolation_tblprop(no_column_tbl)
     self.__run_sampling_test(no_column_tbl, columns, part_test_tbl_base, 10, 7)
 
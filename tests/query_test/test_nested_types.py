@@ -433,13 +433,13 @@ class TestParquetArrayEncodings(ImpalaTestSuite):
     self._create_test_table(unique_database, tablename,
         "UnannotatedListOfPrimitives.parquet", "col1 array<int>")
 
-    result = self.execute_query("select item from %s.col1" % full_name, qopts)
-    assert result.data == ['34', '35', '36']
-    result = self.execute_query("select item from %s t, t.col1" % full_name, qopts)
-    assert result.data == ['34', '35', '36']
-    result = self.execute_query(
-      "select cnt from %s t, (select count(*) cnt from t.col1) v" % full_name, qopts)
-    assert result.data == ['3']
+    results = self.execute_queries([
+      "select item from %s.col1" % full_name,
+      "select item from %s t, t.col1" % full_name,
+      "select cnt from %s t, (select count(*) cnt from t.col1) v" % full_name], qopts)
+    assert results[0].data == ['34', '35', '36']
+    assert results[1].data == ['34', '35', '36']
+    assert results[2].data == ['3']
 
   # $ parquet-tools schema UnannotatedListOfGroups.parquet
   # message UnannotatedListOfGroups {
@@ -463,13 +463,13 @@ class TestParquetArrayEncodings(ImpalaTestSuite):
     self._create_test_table(unique_database, tablename,
         "UnannotatedListOfGroups.parquet", "col1 array<struct<f1: float, f2: float>>")
 
-    result = self.execute_query("select f1, f2 from %s.col1" % full_name, qopts)
-    assert result.data == ['1\t1', '2\t2']
-    result = self.execute_query("select f1, f2 from %s t, t.col1" % full_name, qopts)
-    assert result.data == ['1\t1', '2\t2']
-    result = self.execute_query(
-      "select cnt from %s t, (select count(*) cnt from t.col1) v" % full_name, qopts)
-    assert result.data == ['2']
+    results = self.execute_queries([
+      "select f1, f2 from %s.col1" % full_name,
+      "select f1, f2 from %s t, t.col1" % full_name,
+      "select cnt from %s t, (select count(*) cnt from t.col1) v" % full_name], qopts)
+    assert results[0].data == ['1\t1', '2\t2']
+    assert results[1].data == ['1\t1', '2\t2']
+    assert results[2].data == ['2']
 
   # $ parquet-tools schema AmbiguousList_Modern.parquet
   # message org.apache.impala.nested {
@@ -15,8 +15,8 @@
 # specific language governing permissions and limitations
 # under the License.
 
-from collections import defaultdict
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from tests.common.impala_cluster import ImpalaCluster
 from tests.common.impala_test_suite import ImpalaTestSuite
 from tests.common.skip import SkipIfS3, SkipIfABFS, SkipIfADLS, SkipIfIsilon, SkipIfLocal
@@ -27,6 +27,62 @@ import pytest
 import re
 
 MAX_THRIFT_PROFILE_WAIT_TIME_S = 300
+# Bounds of the interval between polling thrift profile fetches.
+MIN_THRIFT_PROFILE_POLL_INTERVAL_S = 0.2
+MAX_THRIFT_PROFILE_POLL_INTERVAL_S = 2.0
+
+# Query options expected in the profile of test_query_options. For its query, the planner
+# sets NUM_NODES=1, NUM_SCANNER_THREADS=1, RUNTIME_FILTER_MODE=0 and MT_DOP=0.
+EXPECTED_QUERY_OPTIONS_STR = ("Query Options (set by configuration and planner): "
+    "MEM_LIMIT=8589934592,"
+    "NUM_NODES=1,NUM_SCANNER_THREADS=1,"
+    "RUNTIME_FILTER_MODE=0,MT_DOP=0," +
+    ("ALLOW_ERASURE_CODED_FILES=1," if IS_EC else "") +
+    "CLIENT_IDENTIFIER="
+    "query_test/test_observability.py::TestObservability::()::test_query_options"
+    "\n")
+
+# Events expected in the profile timelines, precompiled once since they are matched
+# against every line of the profiles.
+QUERY_EVENT_REGEXES = tuple(re.compile(regex) for regex in [
+    r'Query Timeline:',
+    r'Query submitted:',
+    r'Planning finished:',
+    r'Submit for admission:',
+    r'Completed admission:',
+    r'Ready to start on .* backends:',
+    r'All .* execution backends \(.* fragment instances\) started:',
+    r'Rows available:',
+    r'First row fetched:',
+    r'Last row fetched:',
+    r'Released admission control resources:'])
+INSTANCE_EVENT_REGEXES = tuple(re.compile(regex) for regex in [
+    r'Fragment Instance Lifecycle Event Timeline',
+    r'Prepare Finished',
+    r'Open Finished',
+    r'First Batch Produced',
+    r'First Batch Sent',
+    r'ExecInternal Finished'])
+NODE_EVENT_REGEXES = tuple(re.compile(regex) for regex in [
+    r'Node Lifecycle Event Timeline',
+    r'Open Started',
+    r'Open Finished',
+    r'First Batch Requested',
+    r'First Batch Returned',
+    r'Last Batch Returned',
+    r'Closed'])
+# Events that show up in the profile of every query, including DDL and DML.
+COMMON_EVENT_REGEXES = tuple(re.compile(regex) for regex in [
+    r'Query Compilation:',
+    r'Query Timeline:',
+    r'Planning finished'])
+# Characters with a special meaning in regexes. Event regexes without any of them are
+# plain substrings.
+REGEX_SPECIAL_CHARS = frozenset('.^$*+?{}[]\\|()')
+# Matches the raw byte count in parentheses after a pretty-printed byte counter.
+BYTE_COUNT_REGEX = re.compile(r"\(([0-9]+)\)")
+# Operator name of an exchange sink in the exec summary.
+EXCHANGE_SENDER_REGEX = re.compile(r"F[0-9]+:EXCHANGE SENDER")
 
 class TestObservability(ImpalaTestSuite):
   @classmethod
@@ -47,11 +103,12 @@ class TestObservability(ImpalaTestSuite):
     assert exchange['est_num_rows'] == 5
     assert exchange['peak_mem'] > 0
 
-    for line in result.runtime_profile.split('\n'):
-      # The first 'RowsProduced' we find is for the coordinator fragment.
-      if 'RowsProduced' in line:
-        assert '(5)' in line
-        break
+    # The first 'RowsProduced' we find is for the coordinator fragment.
+    profile = result.runtime_profile
+    start = profile.find('RowsProduced')
+    assert start != -1, profile
+    end = profile.find('\n', start)
+    assert '(5)' in profile[start:end if end != -1 else None]
 
   def test_broadcast_num_rows(self):
     """Regression test for IMPALA-3002 - checks that the num_rows for a broadcast node
@@ -75,19 +132,39 @@ class TestObservability(ImpalaTestSuite):
     query_id = handle.get_handle().id
 
     num_validated = 0
-    tree = self.impalad_test_service.get_thrift_profile(query_id,
-        MAX_THRIFT_PROFILE_WAIT_TIME_S)
-    while self.client.get_state(handle) != self.client.QUERY_STATES['FINISHED']:
-      assert tree, num_validated
-      for node in tree.nodes:
-        if node.name.startswith('Instance '):
-          info_strings_key = 'Last report received time'
-          assert info_strings_key in node.info_strings
-          report_time_str = node.info_strings[info_strings_key].split(".")[0]
-          # Try converting the string to make sure it's in the expected format
-          assert datetime.strptime(report_time_str, '%Y-%m-%d %H:%M:%S')
-          num_validated += 1
-      tree = self.impalad_test_service.get_thrift_profile(query_id)
+    poll_interval = MIN_THRIFT_PROFILE_POLL_INTERVAL_S
+    last_report_times = None
+    # Each profile is fetched in the background while the query state is checked, so the
+    # two round trips overlap. Only this thread uses the client.
+    pool = ThreadPool(processes=1)
+    try:
+      pending_tree = pool.apply_async(self.impalad_test_service.get_thrift_profile,
+          (query_id, MAX_THRIFT_PROFILE_WAIT_TIME_S))
+      while self.client.get_state(handle) != self.client.QUERY_STATES['FINISHED']:
+        tree = pending_tree.get()
+        assert tree, num_validated
+        report_times = []
+        for node in tree.nodes:
+          if node.name.startswith('Instance '):
+            info_strings_key = 'Last report received time'
+            assert info_strings_key in node.info_strings
+            report_times.append(node.info_strings[info_strings_key])
+            report_time_str = node.info_strings[info_strings_key].split(".")[0]
+            # Try converting the string to make sure it's in the expected format
+            assert datetime.strptime(report_time_str, '%Y-%m-%d %H:%M:%S')
+            num_validated += 1
+        # Poll quickly while new reports arrive and back off while the profile does not
+        # change, to avoid needlessly loading the webserver.
+        if report_times != last_report_times:
+          poll_interval = MIN_THRIFT_PROFILE_POLL_INTERVAL_S
+        else:
+          poll_interval = min(poll_interval * 1.5, MAX_THRIFT_PROFILE_POLL_INTERVAL_S)
+        last_report_times = report_times
+        sleep(poll_interval)
+        pending_tree = pool.apply_async(self.impalad_test_service.get_thrift_profile,
+            (query_id,))
+    finally:
+      pool.terminate()
     assert num_validated > 0
     self.client.close_query(handle)
 
@@ -133,18 +210,16 @@ class TestObservability(ImpalaTestSuite):
     assert root_sink['peak_mem'] >= 0
     assert root_sink['est_peak_mem'] >= 0
     # Sanity-check the exchange sink.
-    found_exchange_sender = False
-    for row in result.exec_summary[1:]:
-      if 'EXCHANGE SENDER' not in row['operator']:
-        continue
-      found_exchange_sender = True
-      assert re.match("F[0-9]+:EXCHANGE SENDER", row['operator'])
+    exchange_senders = self.__index_exec_summary(result.exec_summary[1:]).get(
+        'EXCHANGE SENDER', [])
+    assert exchange_senders, result
+    for row in exchange_senders:
+      assert EXCHANGE_SENDER_REGEX.match(row['operator'])
       assert row['max_time'] >= 0
       assert row['num_rows'] == -1
       assert row['est_num_rows'] == -1
       assert row['peak_mem'] >= 0
       assert row['est_peak_mem'] >= 0
-    assert found_exchange_sender, result
 
     # INSERT query.
     query = "create table {0}.tmp as select count(*) from functional.alltypes".format(
@@ -158,6 +233,15 @@ class TestObservability(ImpalaTestSuite):
     assert result.exec_summary[0]['peak_mem'] >= 0
     assert result.exec_summary[0]['est_peak_mem'] >= 0
 
+  def __index_exec_summary(self, exec_summary):
+    """Returns a dict from operator kind, e.g. 'EXCHANGE SENDER' for
+    'F02:EXCHANGE SENDER', to the rows of 'exec_summary' with that kind."""
+    rows_by_kind = {}
+    for row in exec_summary:
+      kind = row['operator'].split(':', 1)[-1]
+      rows_by_kind.setdefault(kind, []).append(row)
+    return rows_by_kind
+
   def test_query_states(self):
     """Tests that the query profile shows expected query states."""
     query = "select count(*) from functional.alltypes"
@@ -190,18 +274,7 @@ class TestObservability(ImpalaTestSuite):
     assert "CLIENT_IDENTIFIER=" + \
         "query_test/test_observability.py::TestObservability::()::test_query_options" \
         in profile
-    # For this query, the planner sets NUM_NODES=1, NUM_SCANNER_THREADS=1,
-    # RUNTIME_FILTER_MODE=0 and MT_DOP=0
-    expected_str = ("Query Options (set by configuration and planner): "
-        "MEM_LIMIT=8589934592,"
-        "NUM_NODES=1,NUM_SCANNER_THREADS=1,"
-        "RUNTIME_FILTER_MODE=0,MT_DOP=0,{erasure_coding}"
-        "CLIENT_IDENTIFIER="
-        "query_test/test_observability.py::TestObservability::()::test_query_options"
-        "\n")
-    expected_str = expected_str.format(
-        erasure_coding="ALLOW_ERASURE_CODED_FILES=1," if IS_EC else "")
-    assert expected_str in profile
+    assert EXPECTED_QUERY_OPTIONS_STR in profile
 
   def test_exec_summary(self):
     """Test that the exec summary is populated correctly in every query state"""
@@ -210,16 +283,16 @@ class TestObservability(ImpalaTestSuite):
         {"debug_action": "CRS_BEFORE_ADMISSION:SLEEP@1000"})
     # If ExecuteStatement() has completed and the query is paused in the admission control
     # phase, then the coordinator has not started yet and exec_summary should be empty.
-    exec_summary = self.client.get_exec_summary(handle)
+    exec_summary, _ = self.__get_exec_summary_and_profile(handle, get_profile=False)
     assert exec_summary is not None and exec_summary.nodes is None
     # After completion of the admission control phase, the coordinator would have started
     # and we should get a populated exec_summary.
     self.client.wait_for_admission_control(handle)
-    exec_summary = self.client.get_exec_summary(handle)
+    exec_summary, _ = self.__get_exec_summary_and_profile(handle, get_profile=False)
     assert exec_summary is not None and exec_summary.nodes is not None
 
     self.client.fetch(query, handle)
-    exec_summary = self.client.get_exec_summary(handle)
+    exec_summary, _ = self.__get_exec_summary_and_profile(handle, get_profile=False)
     # After fetching the results and reaching finished state, we should still be able to
     # fetch an exec_summary.
     assert exec_summary is not None and exec_summary.nodes is not None
@@ -233,20 +306,28 @@ class TestObservability(ImpalaTestSuite):
 
     # If ExecuteStatement() has completed and the query is paused in the admission control
     # phase, then the coordinator has not started yet and exec_summary should be empty.
-    profile = self.client.get_runtime_profile(handle)
+    _, profile = self.__get_exec_summary_and_profile(handle, get_summary=False)
     assert "ExecSummary:" not in profile, profile
     # After completion of the admission control phase, the coordinator would have started
     # and we should get a populated exec_summary.
     self.client.wait_for_admission_control(handle)
-    profile = self.client.get_runtime_profile(handle)
+    _, profile = self.__get_exec_summary_and_profile(handle, get_summary=False)
     assert "ExecSummary:" in profile, profile
 
     self.client.fetch(query, handle)
     # After fetching the results and reaching finished state, we should still be able to
     # fetch an exec_summary in profile.
-    profile = self.client.get_runtime_profile(handle)
+    _, profile = self.__get_exec_summary_and_profile(handle, get_summary=False)
     assert "ExecSummary:" in profile, profile
 
+  def __get_exec_summary_and_profile(self, handle, get_summary=True, get_profile=True):
+    """Returns (exec summary, runtime profile) of 'handle'. There is no RPC that returns
+    both, so each one that is asked for costs an RPC. The ones not asked for are None, so
+    that a test checking only one of them keeps the other RPC out of its timing."""
+    exec_summary = self.client.get_exec_summary(handle) if get_summary else None
+    profile = self.client.get_runtime_profile(handle) if get_profile else None
+    return exec_summary, profile
+
   @SkipIfLocal.multiple_impalad
   def test_profile_fragment_instances(self):
     """IMPALA-6081: Test that the expected number of fragment instances and their exec
@@ -271,102 +352,80 @@ class TestObservability(ImpalaTestSuite):
 
   def test_query_profile_contains_query_events(self):
     """Test that the expected events show up in a query profile."""
-    event_regexes = [r'Query Timeline:',
-        r'Query submitted:',
-        r'Planning finished:',
-        r'Submit for admission:',
-        r'Completed admission:',
-        r'Ready to start on .* backends:',
-        r'All .* execution backends \(.* fragment instances\) started:',
-        r'Rows available:',
-        r'First row fetched:',
-        r'Last row fetched:',
-        r'Released admission control resources:']
     query = "select * from functional.alltypes"
     runtime_profile = self.execute_query(query).runtime_profile
-    self.__verify_profile_event_sequence(event_regexes, runtime_profile)
+    self.__verify_profile_event_sequence(QUERY_EVENT_REGEXES, runtime_profile)
+
+  @pytest.fixture(scope="class")
+  def count_star_profile(self):
+    """Runtime profile of a simple count(*) query, shared by the tests of this class that
+    only inspect its timelines."""
+    query = "select count(*) from functional.alltypes"
+    return self.execute_query(query).runtime_profile
 
-  def test_query_profile_contains_instance_events(self):
+  def test_query_profile_contains_instance_events(self, count_star_profile):
     """Test that /query_profile_encoded contains an event timeline for fragment
     instances, even when there are errors."""
-    event_regexes = [r'Fragment Instance Lifecycle Event Timeline',
-                     r'Prepare Finished',
-                     r'Open Finished',
-                     r'First Batch Produced',
-                     r'First Batch Sent',
-                     r'ExecInternal Finished']
-    query = "select count(*) from functional.alltypes"
-    runtime_profile = self.execute_query(query).runtime_profile
-    self.__verify_profile_event_sequence(event_regexes, runtime_profile)
+    self.__verify_profile_event_sequence(INSTANCE_EVENT_REGEXES, count_star_profile)
 
-  def test_query_profile_contains_node_events(self):
+  def test_query_profile_contains_node_events(self, count_star_profile):
     """Test that ExecNode events show up in a profile."""
-    event_regexes = [r'Node Lifecycle Event Timeline',
-                     r'Open Started',
-                     r'Open Finished',
-                     r'First Batch Requested',
-                     r'First Batch Returned',
-                     r'Last Batch Returned',
-                     r'Closed']
-    query = "select count(*) from functional.alltypes"
-    runtime_profile = self.execute_query(query).runtime_profile
-    self.__verify_profile_event_sequence(event_regexes, runtime_profile)
+    self.__verify_profile_event_sequence(NODE_EVENT_REGEXES, count_star_profile)
 
   def __verify_profile_event_sequence(self, event_regexes, runtime_profile):
-    """Check that 'event_regexes' appear in a consecutive series of lines in
+    """Check that the compiled 'event_regexes' appear in a consecutive series of lines in
        'runtime_profile'"""
-    lines = runtime_profile.splitlines()
-    event_regex_index = 0
-
-    # Check that the strings appear in the above order with no gaps in the profile.
-    for line in runtime_profile.splitlines():
-      match = re.search(event_regexes[event_regex_index], line)
-      if match is not None:
-        event_regex_index += 1
-        if event_regex_index == len(event_regexes):
-          # Found all the lines - we're done.
-          return
-      else:
-        # Haven't found the first regex yet.
-        assert event_regex_index == 0, \
-            event_regexes[event_regex_index] + " not in " + line + "\n" + runtime_profile
-    assert event_regex_index == len(event_regexes), \
+    # Find the first event with a single search of the whole profile. None of the
+    # patterns match a newline, so this is the first line that contains the event.
+    match = event_regexes[0].search(runtime_profile)
+    assert match is not None, "Didn't find all events in profile: \n" + runtime_profile
+    line_start = runtime_profile.rfind('\n', 0, match.start()) + 1
+    lines = runtime_profile[line_start:].splitlines()
+    assert len(lines) >= len(event_regexes), \
         "Didn't find all events in profile: \n" + runtime_profile
 
+    # Check that the other strings follow in the above order with no gaps in the profile.
+    for event_regex, line in zip(event_regexes[1:], lines[1:]):
+      assert event_regex.search(line) is not None, \
+          "%s not in %s\n%s" % (event_regex.pattern, line, runtime_profile)
+
   def test_query_profile_contains_all_events(self, unique_database):
     """Test that the expected events show up in a query profile for various queries"""
     # make a data file to load data from
     path = "test-warehouse/{0}.db/data_file".format(unique_database)
     self.filesystem_client.create_file(path, "1")
-    use_query = "use {0}".format(unique_database)
-    self.execute_query(use_query)
-    # all the events we will see for every query
-    event_regexes = [
-      r'Query Compilation:',
-      r'Query Timeline:',
-      r'Planning finished'
-    ]
+    # Table names are qualified, so the shared client's session database is left alone.
+    table_name = "{0}.impala_6568".format(unique_database)
     # queries that explore different code paths in Frontend compilation
     queries = [
-      'create table if not exists impala_6568 (i int)',
-      'select * from impala_6568',
-      'explain select * from impala_6568',
-      'describe impala_6568',
-      'alter table impala_6568 set tblproperties(\'numRows\'=\'10\')',
-      "load data inpath '/{0}' into table impala_6568".format(path)
+      'create table if not exists {0} (i int)'.format(table_name),
+      'select * from {0}'.format(table_name),
+      'explain select * from {0}'.format(table_name),
+      'describe {0}'.format(table_name),
+      'alter table {0} set tblproperties(\'numRows\'=\'10\')'.format(table_name),
+      "load data inpath '/{0}' into table {1}".format(path, table_name)
     ]
     # run each query...
     for query in queries:
       runtime_profile = self.execute_query(query).runtime_profile
       # and check that all the expected events appear in the resulting profile
-      self.__verify_profile_contains_every_event(event_regexes, runtime_profile, query)
+      self.__verify_profile_contains_every_event(
+          COMMON_EVENT_REGEXES, runtime_profile, query)
 
   def __verify_profile_contains_every_event(self, event_regexes, runtime_profile, query):
-    """Test that all the expected events show up in a given query profile."""
-    for regex in event_regexes:
-      assert any(re.search(regex, line) for line in runtime_profile.splitlines()), \
-          "Didn't find event '" + regex + "' for query '" + query + \
-          "' in profile: \n" + runtime_profile
+    """Test that all the expected events, given as compiled 'event_regexes', show up in a
+    given query profile."""
+    # Plain substrings can be looked up in the whole profile, without splitting it.
+    remaining = [regex for regex in event_regexes
+                 if REGEX_SPECIAL_CHARS.intersection(regex.pattern)
+                 or regex.pattern not in runtime_profile]
+    if not remaining: return
+    # Scan the profile once, dropping each event as soon as a line matches it.
+    for line in runtime_profile.splitlines():
+      remaining = [regex for regex in remaining if not regex.search(line)]
+      if not remaining: return
+    assert False, "Didn't find events %s for query '%s' in profile: \n%s" % (
+        [regex.pattern for regex in remaining], query, runtime_profile)
 
   def test_compute_stats_profile(self, unique_database):
     """Test that the profile for a 'compute stats' query contains three unique query ids:
@@ -376,11 +435,7 @@ class TestObservability(ImpalaTestSuite):
         "create table %s as select * from functional.alltypestiny" % table_name)
     results = self.execute_query("compute stats %s" % table_name)
     # Search for all query ids (max length 33) in the profile.
-    matches = re.findall("Query \(id=.{,33}\)", results.runtime_profile)
-    query_ids = []
-    for query_id in matches:
-      if query_id not in query_ids:
-        query_ids.append(query_id)
+    query_ids = set(re.findall("Query \(id=.{,33}\)", results.runtime_profile))
     assert len(query_ids) == 3, results.runtime_profile
 
   def test_global_resource_counters_in_profile(self):
@@ -400,19 +455,21 @@ class TestObservability(ImpalaTestSuite):
     assert "ExchangeScanRatio: 3.19" in profile
 
     keys = ["TotalBytesSent", "TotalScanBytesSent", "TotalInnerBytesSent"]
-    counters = defaultdict(int)
+    counters = dict.fromkeys(keys)
     for line in profile.splitlines():
       for key in keys:
         if key in line:
           # Match byte count within parentheses
-          m = re.search("\(([0-9]+)\)", line)
+          m = BYTE_COUNT_REGEX.search(line)
           assert m
           # Only keep first (query-level) counter
-          if counters[key] == 0:
+          if counters[key] is None:
             counters[key] = int(m.group(1))
+          # Each line holds a single counter.
+          break
 
     # All counters have values
-    assert all(counters[key] > 0 for key in keys)
+    assert all(counters[key] > 0 for key in keys), counters
 
     assert counters["TotalBytesSent"] == (counters["TotalScanBytesSent"] +
                                           counters["TotalInnerBytesSent"])
@@ -440,11 +497,15 @@ class TestThriftProfile(ImpalaTestSuite):
 
     start = time()
     end = start + MAX_THRIFT_PROFILE_WAIT_TIME_S
+    poll_interval = MIN_THRIFT_PROFILE_POLL_INTERVAL_S
     while time() <= end:
       # Sleep before trying to fetch the profile. This helps to prevent a warning when the
       # profile is not yet available immediately. It also makes it less likely to
-      # introduce an error below in future changes by forgetting to sleep.
-      sleep(1)
+      # introduce an error below in future changes by forgetting to sleep. The interval
+      # starts short, since the profile is usually final soon after closing the client,
+      # and grows while it is not.
+      sleep(poll_interval)
+      poll_interval = min(poll_interval * 1.5, MAX_THRIFT_PROFILE_POLL_INTERVAL_S)
       tree = self.impalad_test_service.get_thrift_profile(query_id)
       if not tree:
         continue